@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the code generation throughput on the evaluation templates.
+
+Only the universe enumeration and code assembly are timed; no file is written.
+With --pruning, report how much work forward checking saves instead.
+
+    python -m benchmarks.codegen [--repeat N] [--pruning] [template ...]
+"""
+import argparse
+import glob
+import os
+import os.path as osp
+import tempfile
+import time
+
+from src.boba.parser import Parser
+
+ROOT = osp.join(osp.dirname(osp.dirname(osp.abspath(__file__))),
+                'evaluation_datasets')
+
+
+def find_templates():
+    pattern = osp.join(ROOT, '*', 'boba_multiverse', '*template.*')
+    return sorted(glob.glob(pattern))
+
+
+def template_name(template):
+    return osp.basename(osp.dirname(osp.dirname(template))) \
+        if template.startswith(ROOT) else osp.basename(template)
+
+
+def bench(template, repeat):
+    """ Return (number of universes, best time in seconds). """
+    with tempfile.TemporaryDirectory() as out:
+        try:
+            ps = Parser(template, out)
+        except SystemExit:
+            return None
+
+        best = None
+        n = 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            n = sum(1 for _ in ps.iter_universes())
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return n, best
+
+
+def bench_pruning(template):
+    """ Return the search stats with and without forward checking. """
+    with tempfile.TemporaryDirectory() as out:
+        try:
+            ps = Parser(template, out)
+        except SystemExit:
+            return None
+
+        res = []
+        for fc in (False, True):
+            gen = ps._get_generator()
+            gen.forward_check = fc
+            for idx in range(len(gen.paths)):
+                for _ in gen.iter_path(idx, render=False):
+                    pass
+            res.append(gen.stats)
+        return res
+
+
+def report_pruning(name, template):
+    res = bench_pruning(template)
+    if res is None:
+        print('{:<30}{:>12}'.format(name, 'failed to parse'))
+        return
+    off, on = res
+    saved = 1 - on['steps'] / off['steps'] if off['steps'] else 0
+    print('{:<30}{:>12}{:>12}{:>12}{:>12}{:>10.1%}'.format(
+        name, off['steps'], on['steps'], off['aborted'], on['pruned'], saved))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    ap.add_argument('templates', nargs='*', help='Template scripts '
+                    '[default: all templates in evaluation_datasets]')
+    ap.add_argument('--repeat', type=int, default=3,
+                    help='Keep the best of this many runs')
+    ap.add_argument('--pruning', action='store_true',
+                    help='Report the chunks walked with and without forward '
+                    'checking')
+    args = ap.parse_args()
+
+    if args.pruning:
+        print('{:<30}{:>12}{:>12}{:>12}{:>12}{:>10}'.format(
+            'Template', 'Steps', 'Steps (FC)', 'Dead ends', 'Pruned',
+            'Saved'))
+        for t in args.templates or find_templates():
+            report_pruning(template_name(t), t)
+        return
+
+    print('{:<30}{:>12}{:>12}{:>16}'.format(
+        'Template', 'Universes', 'Seconds', 'Universes/sec'))
+    for t in args.templates or find_templates():
+        name = template_name(t)
+        res = bench(t, args.repeat)
+        if res is None:
+            print('{:<30}{:>12}'.format(name, 'failed to parse'))
+            continue
+        n, sec = res
+        print('{:<30}{:>12}{:>12.3f}{:>16.0f}'.format(name, n, sec, n / sec))
+
+
+if __name__ == '__main__':
+    main()
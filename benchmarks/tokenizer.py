@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the regex tokenizer with the character scanners on the evaluation
+templates.
+
+Each template is padded with lines of inlined data, as in a generated script,
+so that tokenizing dominates. Only the per-line tokenizing is timed.
+
+    python -m benchmarks.tokenizer [--repeat N] [--lines N] [template ...]
+"""
+import argparse
+import random
+import time
+
+from src.boba import tokenizer
+from src.boba.blocksyntaxparser import BlockSyntaxParser
+from src.boba.decisionparser import DecisionParser
+from benchmarks.codegen import find_templates, template_name
+
+
+def read_lines(template, n_data):
+    """ The template lines, followed by n_data lines of inlined data. """
+    with open(template) as f:
+        lines = f.readlines()
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+
+    rnd = random.Random(0)
+    for _ in range(n_data):
+        row = ', '.join('{:.4f}'.format(rnd.random()) for _ in range(8))
+        lines.append('  c({}),\n'.format(row))
+    return lines
+
+
+def scan(lines):
+    dp = DecisionParser()
+    for line in lines:
+        if BlockSyntaxParser.can_parse(line):
+            BlockSyntaxParser(line).parse()
+        else:
+            dp.parse_code(line)
+
+
+def tokenize(lines):
+    dp = DecisionParser()
+    for line in lines:
+        if tokenizer.is_block(line):
+            tokenizer.parse_block(line)
+        else:
+            dp.tokenize_code(line)
+
+
+def best_of(fn, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(lines)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    ap.add_argument('templates', nargs='*', help='Template scripts '
+                    '[default: all templates in evaluation_datasets]')
+    ap.add_argument('--repeat', type=int, default=3,
+                    help='Keep the best of this many runs')
+    ap.add_argument('--lines', type=int, default=20000,
+                    help='Lines of inlined data to add to each template')
+    args = ap.parse_args()
+
+    print('{:<30}{:>10}{:>12}{:>12}{:>10}'.format(
+        'Template', 'Lines', 'Scanner', 'Regex', 'Speedup'))
+    for t in args.templates or find_templates():
+        lines = read_lines(t, args.lines)
+        old = best_of(scan, lines, args.repeat)
+        new = best_of(tokenize, lines, args.repeat)
+        print('{:<30}{:>10}{:>12.3f}{:>12.3f}{:>9.1f}x'.format(
+            template_name(t), len(lines), old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -20,7 +20,8 @@ import json
 from string_grouper import group_similar_strings
 from src.boba.bobarun import BobaRun
 from src.boba.lang import Lang
-from src.boba.wrangler import DIR_LOG, DIR_SCRIPT
+from src.boba.wrangler import DIR_LOG, DIR_SCRIPT, read_summary, read_decision_matrix
+from src.boba.decisionmatrix import DecisionMatrix
 
 class bcolors:
 	HEADER = '\033[95m'
@@ -56,10 +57,6 @@ def decisions_set_unique(fr_set_tup, orig_decision_dict):
 		return {"All Universes": ["All Options"]}
 	return orig_dict
 
-def get_decs(summary_df) -> Dict[str, list]:
-	return {c : summary_df[c].replace('', np.nan).dropna().unique()
-			for c in summary_df.columns[1:]}
-	
 def set_universe_as_index(summary_df):
 	summary_df['universe_num'] = summary_df['Filename'].apply(lambda x: int(x.split('_')[-1].split('.')[0]))
 	return summary_df.set_index('universe_num')
@@ -151,9 +148,10 @@ class DebugMultiverse:
 		self.log_folder = os.path.join(folder, DIR_LOG)
 		self.file_log = os.path.join(self.log_folder, 'logs.csv')
 		self.code_folder = osp.join(folder, DIR_SCRIPT)
-		self.summary_df = pd.read_csv(osp.join(self.folder, 'summary.csv')).fillna('')
+		self.summary_df = read_summary(self.folder, na_value='')
 		self.summary_df = set_universe_as_index(self.summary_df)
-		self.decisions = get_decs(self.summary_df)
+		self.matrix = read_decision_matrix(self.folder)
+		self.decisions = {c: self.matrix.get_options(c) for c in self.matrix.names}
 		fn = self.summary_df['Filename'].to_list()[0]
 		try:
 			with open(self.folder + '/lang.json', 'r') as f:
@@ -294,8 +292,7 @@ class DebugMultiverse:
 		
 		decisions_to_lines = defaultdict(list)
 		for k, line in common_lines.items():
-			subset_df = summary_df.loc[list(k)]
-			decisions = {k: frozenset(v) for k, v in get_decs(subset_df).items()}
+			decisions = {c: frozenset(self.matrix.get_options(c, k)) for c in self.matrix.names}
 			decisions = {k: v for k, v in decisions.items() if k in self.orig_decisions}
 			decisions_repr = tuple((k, decisions[k])for k in sorted(decisions.keys())) 
 			decisions_to_lines[decisions_repr].extend(line)
@@ -363,25 +360,28 @@ class DebugMultiverse:
 			print(f'{bcolors.OKGREEN}Total shared: {len(other_unums)}\n\n')
 
 	# TODO what are common decisions shared by two universes
-def get_min_decisions(summary_df: pd.DataFrame):
-	decision_options_dict: Dict[str, list] = {c: list(summary_df[c].unique())
-												  for c in summary_df.columns[2:]}
-	decision_options_dict = {k: set(v) for k, v in decision_options_dict.items() if len(v) > 1}
-	summary_df = set_universe_as_index(summary_df)
-	copy_df = deepcopy(summary_df)
+def get_min_decisions(matrix: DecisionMatrix):
+	# the decisions, without the code path
+	codes = matrix.codes[:, 1:]
+	decision_options_dict: Dict[int, set] = {j: set(np.unique(codes[:, j]))
+											  for j in range(codes.shape[1])}
+	decision_options_dict = {k: v for k, v in decision_options_dict.items() if len(v) > 1}
+	remaining = np.arange(len(matrix))
 	to_run = {}
 	
-	while len(copy_df) > 0 and any(len(v) > 0 for v in decision_options_dict.values()):
-		row = copy_df.sample(1)
-		to_run[row.index.values[0]] = {c: row[c].values[0] for c in row.columns[2:]}
-		cols = [(c, copy_df[c].nunique()) 
-				for c in copy_df.columns[2:] if copy_df[c].nunique() > 1]
+	while len(remaining) > 0 and any(len(v) > 0 for v in decision_options_dict.values()):
+		uid = int(np.random.choice(remaining)) + 1
+		row = codes[uid - 1]
+		to_run[uid] = {c: v for c, v in matrix.get_decisions(uid).items() if c != matrix.names[0]}
+		subset = codes[remaining]
+		cols = [(j, n) for j, n in ((j, len(np.unique(subset[:, j][subset[:, j] >= 0])))
+									for j in range(codes.shape[1])) if n > 1]
 		if len(cols) == 0:
 			break
 		max_col = sorted(cols, key=lambda x: x[1])[-1][0]
 		for col, v in decision_options_dict.items():
-			v.discard(row[col].values[0])  
-		copy_df = copy_df.loc[copy_df[max_col] != row[max_col].values[0]]
+			v.discard(row[col])
+		remaining = remaining[subset[:, max_col] != row[max_col]]
 		
 	return to_run
 
@@ -489,11 +489,10 @@ if __name__ == '__main__':
 	from os.path import join
 	MULTIVERSE_FOLDER = ""
 	LOG_FOLDER = join(MULTIVERSE_FOLDER, 'multiverse', 'boba_logs')
-	SUM_DF_PATH = join(MULTIVERSE_FOLDER, 'multiverse', 'summary.csv')
+	SUM_DF_FOLDER = join(MULTIVERSE_FOLDER, 'multiverse')
 	
 	# merge_error(LOG_FOLDER)
-	df = pd.read_csv(SUM_DF_PATH)
-	min_decs = get_min_decisions(df)
+	min_decs = get_min_decisions(read_decision_matrix(SUM_DF_FOLDER))
 	print(f'{bcolors.OKCYAN}====== Sampled Universes to Run ======')
 	pprint(min_decs)
 	debug_multiverse = DebugMultiverse(join(MULTIVERSE_FOLDER, 'multiverse'))
@@ -77,7 +77,7 @@ class ASTDiff:
         
         
     def _get_ast_diff_changes(self):
-        changed_code_history = self.boba_parser.history[self.universe_num - 1]
+        changed_code_history = self.boba_parser.get_universe(self.universe_num)[0]
         path_ind = changed_code_history.path
         changed_code_ast = ast.parse(self.changed_code)
         orig_code_template_ast = self.boba_parser.paths_ast[path_ind]
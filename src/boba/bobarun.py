@@ -1,25 +1,50 @@
-import subprocess
+import asyncio
+import time
+import numpy as np
 import pandas as pd
 import os
 import json
+import collections
+import functools
 import multiprocessing as mp
-from subprocess import PIPE
+from asyncio.subprocess import PIPE
 from .lang import Lang
+from .parser import load_parser
+from .syntaxcheck import get_grammar, check_code
+from .warmstart import WarmWorker, WorkerLost, available as warm_available
+from .rworker import RWorker, available as r_available
+from .forkrun import ForkTree, split_script, build_tree, \
+    available as fork_available
 from .wrangler import *
 
 
 class BobaRun:
-    def __init__(self, folder, jobs=1, batch_size=0):
+    def __init__(self, folder, jobs=1, batch_size=0, check_syntax=False,
+                 preload=None, fork=False):
         # attributes
         self.folder = folder
+        self.check_syntax = check_syntax
+        self.preload = preload
+        self.fork = fork
         self.dir_log = os.path.join(folder, DIR_LOG)
         self.file_log = os.path.join(self.dir_log, 'logs.csv')
-        self.pool = None
+        self.loop = None
+        self.running = set()
+        self.stopped = False
         self.exit_code = []
 
-        # read summary
-        data = pd.read_csv(self.folder + '/summary.csv')
-        self.size = data.shape[0]
+        # read summary, and the decision matrix when it is needed
+        recover_dir(self.folder)
+        self.size, fn = peek_summary(self.folder)
+        self.decisions = None
+
+        # universes with identical code only run once
+        self.aliases = {}
+        try:
+            with open(os.path.join(self.folder, FILE_ALIASES), 'r') as f:
+                self.aliases = {int(k): v for k, v in json.load(f).items()}
+        except IOError:
+            pass
 
         # multiprocessing attributes
         if jobs == 0:
@@ -30,7 +55,6 @@ class BobaRun:
         self.batch_size = batch_size
 
         # language
-        fn = data['Filename'].to_list()[0]
         try:
             with open(self.folder + '/lang.json', 'r') as f:
                 self.lang = Lang(fn, supported_langs=json.load(f))
@@ -51,9 +75,19 @@ class BobaRun:
         if self.is_running():
             return
 
-        # initialize process pool
-        self.pool = mp.Pool(self.jobs)
+        # the event loop that supervises the universes, which also marks the
+        # run as in progress until it ends, even if it fails
+        self.loop = asyncio.new_event_loop()
+        self.stopped = False
+        try:
+            self._run_multiverse(universes, resume)
+        finally:
+            loop, self.loop = self.loop, None
+            loop.close()
 
+
+    def _run_multiverse(self, universes, resume):
+        """ Run the multiverse, in the event loop of run_multiverse """
         # by default, run all universes
         if not len(universes):
             universes = list(range(1, self.size + 1))
@@ -64,40 +98,235 @@ class BobaRun:
 
             # initialize the log folder and log file
             self.exit_code = []
-            if os.path.exists(self.dir_log):
-                shutil.rmtree(self.dir_log)
+            rotate_dir(self.dir_log)
             os.makedirs(self.dir_log)
 
             with open(self.file_log, 'w') as log:
-                log.write('uid,exit_code\n')
+                log.write('uid,exit_code,seconds\n')
+
+        # run each unique script once, on behalf of all its aliases
+        copies = {}
+        unique = []
+        for u in universes:
+            c = self.aliases.get(u, u)
+            if c not in copies:
+                copies[c] = []
+                unique.append(c)
+            if c != u:
+                copies[c].append(u)
+        universes = unique
 
         # callback that is run for each retrieved result.
-        # FIXME: if stopped, the last batch will not invoke the callback
+        runtimes = read_runtimes(self.folder, self.size)
         def check_result(r):
+            r = self.copy_results(r, copies)
             self.exit_code += [[res[0], res[1]] for res in r]
             # write the results to our logs
             with open(self.file_log, 'a') as f_log:
-                for res in r:
-                    f_log.write(f'{res[0]},{res[1]}\n')
+                for uid, code, sec in r:
+                    f_log.write('{},{},{}\n'.format(
+                        uid, code, '' if sec is None else round(sec, 3)))
+                    if sec is not None:
+                        runtimes[uid - 1] = sec
+
+        # universes that cannot be parsed fail without running
+        if self.check_syntax:
+            failed = self.find_syntax_errors(universes)
+            if len(failed):
+                print('{} universes have syntax errors and will not run.'
+                      .format(len(failed)))
+                check_result(self.log_syntax_errors(failed))
+                universes = [u for u in universes if u not in failed]
+
+        # run the universes, the longest first, recording each as it finishes
+        universes = self.order_by_runtime(universes)
+        supervise = self.supervise
+        if self.fork:
+            if self.lang.is_python() and fork_available() and \
+                    _get_parser(self.folder) is not None:
+                supervise = self.supervise_forked
+            else:
+                print('Cannot share the prefixes of these universes, running '
+                      'each on its own.')
+        try:
+            self.loop.run_until_complete(supervise(universes, check_result))
+        finally:
+            write_runtimes(self.folder, runtimes)
 
-        # run each batch of universes as a separate task
-        while len(universes):
-            batch = []
-            while len(universes) and len(batch) < self.batch_size:
-                u = get_universe_script(universes.pop(0), self.lang.get_ext())
-                batch.append(u)
+        # after execute
+        self.run_commands_in_folder('post_exe.sh')
 
-            self.pool.apply_async(run_batch_of_universes,
-                args=(self.folder, batch, self.lang.supported_langs),
-                callback=check_result)
 
-        # collect all the results
-        self.pool.close()
-        self.pool.join()
+    async def supervise(self, universes, callback):
+        """
+        Run the universes as child processes of this event loop, at most
+        self.jobs at a time. The universes form one queue, and whichever
+        worker is free takes the next, so a slow universe never holds up
+        others behind it.
 
-        # after execute
-        self.run_commands_in_folder('post_exe.sh')
-        self.pool = None
+        Parameters:
+         - universes: a list of universe ids, in the order to start them
+         - callback: called with [(universe id, exit code, seconds)] as each
+           finishes
+        """
+        pending = collections.deque(universes)
+
+        # python and R universes can run in workers that preload modules
+        make_worker = None
+        if self.preload is not None:
+            if self.lang.is_python() and warm_available():
+                make_worker = WarmWorker
+            elif self.lang.is_r() and r_available():
+                make_worker = RWorker
+
+        async def worker():
+            warm = make_worker(self.preload) if make_worker else None
+            try:
+                while len(pending):
+                    u = pending.popleft()
+                    if self.stopped:
+                        return
+                    script = get_universe_script(u, self.lang.get_ext())
+                    res = await run_universe(self.folder, script,
+                                             self.lang.supported_langs,
+                                             self.running, warm)
+                    if not self.stopped:
+                        callback([res])
+            finally:
+                if warm is not None:
+                    await warm.close()
+
+        await asyncio.gather(*[worker() for _ in range(self.jobs)])
+
+
+    async def supervise_forked(self, universes, callback):
+        """
+        Run the universes as a tree of processes, where the blocks that
+        universes share run once, and report the CPU time it saved.
+
+        Parameters:
+         - universes: a list of universe ids
+         - callback: called with [(universe id, exit code, seconds)] as each
+           finishes
+        """
+        layouts = []
+        ext = self.lang.get_ext()
+        cwd = os.path.abspath(os.path.join(self.folder, DIR_SCRIPT))
+        for u in universes:
+            blocks = read_history(self.folder, u).blocks
+            bounds = np.cumsum([b.code_num_lines for b in blocks]).tolist()
+            code = read_universe(self.folder, u, ext)
+            layouts.append((u, os.path.join(cwd, get_universe_script(u, ext)),
+                            split_script(code, bounds)))
+
+        tree = ForkTree(build_tree(layouts), cwd, self.jobs)
+        await tree.start()
+        self.running.add(tree)
+        try:
+            async for uid, out, err, code, sec in tree.results():
+                write_universe_logs(self.folder, uid, out, err)
+                if not self.stopped:
+                    callback([(uid, code, sec)])
+        finally:
+            self.running.discard(tree)
+            await tree.wait()
+            cpu, alone = tree.cpu_time()
+            tree.close()
+
+        if alone > 0:
+            print('Sharing prefixes took {:.1f}s of CPU time instead of {:.1f}s, '
+                  'saving {:.1f}s ({:.0%}).'.format(cpu, alone, alone - cpu,
+                                                   (alone - cpu) / alone))
+        with open(os.path.join(self.dir_log, FILE_FORK), 'w') as f:
+            json.dump({'universes': len(tree.done), 'nodes': len(tree.nodes),
+                       'cpu': round(cpu, 6), 'cpu_alone': round(alone, 6),
+                       'cpu_saved': round(alone - cpu, 6)}, f, indent=2)
+
+
+    def order_by_runtime(self, universes):
+        """
+        Sort the universes so that the longest start first, which keeps every
+        job busy until close to the end. Run times come from previous runs, for
+        example a run of the minimum cover, and are estimated from the options
+        of a universe if it has not run yet. Without any previous run, the
+        order is unchanged.
+
+        Parameters:
+         - universes: a list of universe ids
+        """
+        runtimes = read_runtimes(self.folder, self.size)
+        if not np.isfinite(runtimes).any():
+            return universes
+        if self.decisions is None:
+            self.decisions = read_decision_matrix(self.folder)
+        est = self.decisions.estimate(runtimes)
+        return sorted(universes, key=lambda u: -est[u - 1])
+
+
+    def find_syntax_errors(self, universes):
+        """
+        Parse the universes in the pool and find those with syntax errors.
+        Each worker reads, or renders, the code of its own batch, so that the
+        code never passes through this process.
+
+        Parameters:
+         - universes: a list of universe ids
+        Returns: a dict from universe id to the error message
+        """
+        grammar = get_grammar(self.lang)
+        if grammar is None:
+            return {}
+
+        size = max(1, len(universes) // (self.jobs * 4) + 1)
+        tasks = [(self.folder, self.lang.get_ext(), grammar,
+                  universes[i:i + size])
+                 for i in range(0, len(universes), size)]
+        res = {}
+        with mp.Pool(self.jobs) as pool:
+            for r in pool.starmap(check_universes, tasks):
+                res.update(r)
+        return res
+
+
+    def log_syntax_errors(self, failed):
+        """
+        Write the error log of universes with syntax errors, which fail as if
+        they had run.
+
+        Parameters:
+         - failed: a dict from universe id to the error message
+        Returns: a list of (universe id, exit code, seconds)
+        """
+        res = []
+        for uid in sorted(failed):
+            msg = 'Syntax error, the universe did not run.\n{}\n'.format(
+                failed[uid])
+            fn = os.path.join(self.dir_log, get_universe_error_log(uid))
+            with open(fn, 'w') as f:
+                f.write(msg)
+            print('[' + get_universe_name(uid) + '] error:\n' + msg, end='')
+            res.append((uid, 1, None))
+        return res
+
+
+    def copy_results(self, results, copies):
+        """
+        Copy the exit code and logs of universes to their aliases.
+
+        Parameters:
+         - results: a list of (universe id, exit code, seconds)
+         - copies: a dict from universe id to a list of its aliases
+        """
+        res = []
+        for uid, code, sec in results:
+            res.append((uid, code, sec))
+            for a in copies.get(uid, []):
+                for log in (get_universe_log, get_universe_error_log):
+                    src = os.path.join(self.dir_log, log(uid))
+                    if os.path.exists(src):
+                        shutil.copyfile(src, os.path.join(self.dir_log, log(a)))
+                res.append((a, code, sec))
+        return res
 
 
     def resume_multiverse(self, universes=[]):
@@ -115,7 +344,7 @@ class BobaRun:
 
         # recover previous progress from log file
         df = pd.read_csv(self.file_log)
-        self.exit_code = df.values.tolist()
+        self.exit_code = df[['uid', 'exit_code']].values.tolist()
 
         # skip scripts that are already run
         lookup = set(df['uid'].tolist())
@@ -124,26 +353,55 @@ class BobaRun:
 
 
     def stop(self):
-        """ Stop all outstanding work in the pool """
-        if self.pool is not None:
+        """ Stop all outstanding work, from any thread """
+        if self.loop is not None:
             print('Terminating')
-            # stop all workers
-            # note that everything after pool.join() will still run
-            self.pool.terminate()
+            # kill the running universes and start no more
+            # note that the post-exe hook will still run
+            self.loop.call_soon_threadsafe(self._terminate)
+
+
+    def _terminate(self):
+        self.stopped = True
+        for proc in self.running:
+            if proc.returncode is None:
+                proc.terminate()
 
 
     def is_running(self):
         """ Whether the multiverse is currently running """
-        return self.pool is not None
+        return self.loop is not None
 
 
-    def run_from_cli(self, run_all=True, num=1, thru=-1):
+    def select(self, conditions):
+        """
+        Get the id of the universes where the decisions take the given options.
+
+        Parameters:
+         - conditions: a dict from decision name to an option, or a list of
+           options
+        """
+        if self.decisions is None:
+            self.decisions = read_decision_matrix(self.folder)
+        for name in conditions:
+            if name not in self.decisions.names:
+                raise KeyError('Unknown decision "{}".'.format(name))
+        return self.decisions.select(conditions).tolist()
+
+
+    def run_from_cli(self, run_all=True, num=1, thru=-1, conditions=None):
         """ Entry point of boba run CLI """
         # get the id of all the universes we want to run
         thru = num if thru == -1 else thru
         start = 1 if run_all else num
         end = self.size if run_all else thru
         universes = list(range(start, end + 1))
+        if conditions:
+            selected = set(self.select(conditions))
+            universes = [u for u in universes if u in selected]
+            if not len(universes):
+                print('No universe matches the given decisions.')
+                return
 
         # run
         self.run_multiverse(universes)
@@ -163,46 +421,182 @@ class BobaRun:
         self.run_commands_in_folder('post_exe.sh')
 
 
-# these two functions can't be in the class because multiprocess
-# does not know how to properly serialize functions in classes
-def run_batch_of_universes(folder, universes, supported_langs):
-    """ Run a batch of universes """
-    batch = []
-    for universe in universes:
-        batch.append(run_universe(folder, universe, supported_langs))
+# the parsers of virtual multiverses, loaded once per process
+_parsers = {}
+
+
+def read_universe(folder, universe_id, ext):
+    """
+    Read the code of a universe, from its script, from the pack or, in a
+    virtual multiverse, by rendering it.
+    """
+    fn = os.path.join(folder, DIR_SCRIPT, get_universe_script(universe_id, ext))
+    if os.path.exists(fn):
+        with open(fn, 'r') as f:
+            return f.read()
+
+    code = read_packed_universe(folder, universe_id)
+    if code is None:
+        _, code = _get_parser(folder).get_universe(universe_id)
+    return code
+
+
+def check_universes(folder, ext, grammar, universes):
+    """
+    Read and parse a batch of universes.
+    :return: a list of (universe id, error message) of those that fail
+    """
+    return check_code(grammar, ((u, read_universe(folder, u, ext))
+                                for u in universes))
 
-    return batch
 
+def _get_parser(folder):
+    if folder not in _parsers:
+        _parsers[folder] = load_parser(folder)
+    return _parsers[folder]
 
-def run_universe(folder, script, supported_langs):
-    """ Run one universe """
+
+def read_history(folder, universe_id):
+    """ The choices made in a universe, and its block layout """
+    history, _ = _get_parser(folder).get_universe(universe_id)
+    return history
+
+
+def extract_universe(folder, script):
+    """ Write the script of a universe that only exists in a pack or virtually """
+    universe_id = get_universe_id_from_script(script)
+    code = read_universe(folder, universe_id, os.path.splitext(script)[1])
+    with open(os.path.join(folder, DIR_SCRIPT, script), 'w') as f:
+        f.write(code)
+
+
+def write_error_log(log_dir, universe_id, err):
+    """
+    Log and print the errors of a universe, if any.
+    :return: whether there are errors
+    """
+    err_decoded = err.decode('utf-8', 'replace')
+    if err_decoded == '':
+        return False
+    with open(os.path.join(log_dir, get_universe_error_log(universe_id)), 'w') as err_log:
+        err_log.write(err_decoded)
+    print('[' + get_universe_name(universe_id) + '] error:\n' + err_decoded,
+          end='')
+    return True
+
+
+def write_universe_logs(folder, universe_id, out, err):
+    """ Log and print what a universe wrote, once it has finished """
+    prefix = '[' + get_universe_name(universe_id) + ']'
+    log_dir = os.path.join(folder, DIR_LOG)
+    with open(os.path.join(log_dir, get_universe_log(universe_id)), 'w') as log:
+        for line in out.splitlines(keepends=True):
+            output = line.decode('utf-8', 'replace')
+            print(prefix + ' ' + output, end='')
+            log.write(output)
+    write_error_log(log_dir, universe_id, err)
+
+
+async def relay_output(stream, prefix, log):
+    """ Print the output of a universe line by line as it arrives, and log it """
+    def emit(line):
+        output = line.decode('utf-8', 'replace')
+        print(prefix + " " + output, end='')
+        log.write(output)
+
+    rest = b''
+    while True:
+        data = await stream.read(1 << 16)
+        if not data:
+            break
+        lines = (rest + data).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            emit(line + b'\n')
+    if rest:
+        emit(rest)
+
+
+async def run_command(cmd, cwd, log, prefix, running, warm=None,
+                      script=None):
+    """
+    Run one command of a universe, or have a worker run the script.
+    :return: (standard error, exit code)
+    """
+    try:
+        if warm is None:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, cwd=cwd, stdout=PIPE, stderr=PIPE)
+            stdout, stderr, wait = proc.stdout, proc.stderr, proc.wait
+        else:
+            proc, stdout, stderr = await warm.spawn(script, cwd)
+            wait = functools.partial(warm.wait, proc)
+    except WorkerLost:
+        raise
+    except OSError as e:
+        # as a shell would report a command that is not found
+        return str(e).encode('utf-8') + b'\n', 127
+
+    running.add(proc)
+    try:
+        with open(log, 'w') as f:
+            err, _ = await asyncio.gather(stderr.read(),
+                                          relay_output(stdout, prefix, f))
+        return err, await wait()
+    finally:
+        running.discard(proc)
+
+
+async def run_universe(folder, script, supported_langs, running=None,
+                       warm=None):
+    """
+    Run one universe. Its output and errors are read at the same time, so
+    that neither pipe can fill up and block the universe.
+
+    Parameters:
+     - running: a set that holds the child process while it runs
+     - warm: a WarmWorker or RWorker to run the script in, if it can. When
+       the worker is lost, the script runs again on its own.
+    """
+    running = set() if running is None else running
     cmds = Lang(script, supported_langs=supported_langs).get_cmd()
 
     universe_id = get_universe_id_from_script(script)
     universe_name_fmt = '[' + get_universe_name(universe_id) + ']'
-    for cmd in cmds:
-        out = subprocess.Popen(cmd, cwd=os.path.join(folder, DIR_SCRIPT),
-                            stdout=PIPE, stderr=PIPE)
-
-        log_dir = os.path.join(folder, DIR_LOG)
-        with open(os.path.join(log_dir, get_universe_log(universe_id)), 'w') as log:
-            while True:
-                # blocks here until next line is availible.
-                output = out.stdout.readline().decode('utf-8')
-                if output == '' and out.poll() is not None:
-                    break
-                if output:
-                    print(universe_name_fmt + " " + output, end='')
-                    log.write(output)
-                rc = out.poll()
-
-        err = out.communicate()[1]
-        err_decoded = err.decode('utf-8')
-        if err_decoded is not '':
-            with open(os.path.join(log_dir, get_universe_error_log(universe_id)), 'w') as err_log:
-                err_log.write(err_decoded)
-            
-            print(universe_name_fmt + ' error:\n' + err_decoded, end='')
-            break
 
-    return universe_id, out.returncode
+    # a universe without a script, as in a packed or virtual multiverse, only
+    # exists while it runs
+    fn = os.path.join(folder, DIR_SCRIPT, script)
+    extracted = not os.path.exists(fn) and can_render(folder)
+    if extracted:
+        extract_universe(folder, script)
+
+    log_dir = os.path.join(folder, DIR_LOG)
+    returncode = None
+    start = time.perf_counter()
+    cwd = os.path.join(folder, DIR_SCRIPT)
+    log = os.path.join(log_dir, get_universe_log(universe_id))
+    try:
+        if warm is not None and not warm.can_run(cmds, script, cwd):
+            warm = None
+        for cmd in cmds:
+            try:
+                err, returncode = await run_command(cmd, cwd, log,
+                                                    universe_name_fmt, running,
+                                                    warm, script)
+            except WorkerLost:
+                # the worker exited in the middle, as if the universe ended
+                # it, so run the universe again on its own
+                warm = None
+                err, returncode = await run_command(cmd, cwd, log,
+                                                    universe_name_fmt, running)
+
+            if write_error_log(log_dir, universe_id, err):
+                break
+    finally:
+        if extracted:
+            os.remove(fn)
+
+    seconds = time.perf_counter() - start
+
+    return universe_id, returncode, seconds
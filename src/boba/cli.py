@@ -5,9 +5,9 @@ import click
 import shutil
 import os
 import os.path as osp
-import pandas as pd
-import pickle
-from src.boba.parser import Parser
+from src.boba.parser import Parser, load_parser
+from src.boba.wrangler import peek_summary, read_decision_matrix, \
+    find_stale_dirs, recover_dir, DIR_LOG
 from src.boba.output.csvmerger import CSVMerger
 from src.boba.bobarun import BobaRun
 from src.aggregate_error import get_min_decisions
@@ -24,14 +24,30 @@ from src.gui import routes_diff, routes_error
               default='.', show_default=True)
 @click.option('--lang', help='Language, can be python/R [default: inferred from file extension]',
               default=None)
-def compile(script, out, lang):
+@click.option('--jobs', default=1, show_default=True,
+              help='The number of processes generating universes, 0 to use all cores.')
+@click.option('--virtual', is_flag=True, default=False,
+              help='Do not write the universe scripts; render them when they run.')
+@click.option('--incremental', is_flag=True, default=False,
+              help='Keep the previous outputs and only rewrite the universes that changed.')
+@click.option('--pack', is_flag=True, default=False,
+              help='Write the universe scripts into one packed file instead of one file each.')
+@click.option('--profile', is_flag=True, default=False,
+              help='Record the time and memory of each compile phase in multiverse/profile.json.')
+def compile(script, out, lang, jobs, virtual, incremental, pack, profile):
     """Generate multiverse analysis from specifications."""
 
     check_path(script)
+    if virtual and jobs != 1:
+        click.secho('A virtual compile only records the decisions of each '
+                    'universe, in one process; ignoring --jobs.', fg='yellow')
+        jobs = 1
 
     click.echo('Creating multiverse from {}'.format(script))
-    ps = Parser(script, out, lang)
-    ps.main()
+    ps = Parser(script, out, lang, profile=profile)
+    ps.main(jobs=jobs, virtual=virtual, incremental=incremental, pack=pack)
+    if profile:
+        click.echo(ps.profiler.format())
 
     ex = """To execute the multiverse, run the following commands:
     boba run --all
@@ -40,6 +56,20 @@ def compile(script, out, lang):
     click.secho(ex, fg='green')
 
 
+@click.command()
+@click.option('--script', '-s', help='Path to template script',
+              default='./template.py', show_default=True)
+@click.option('--lang', help='Language, can be python/R [default: inferred from file extension]',
+              default=None)
+def count(script, lang):
+    """Count the universes without generating them."""
+
+    check_path(script)
+
+    ps = Parser(script, lang=lang)
+    click.echo(ps.count())
+
+
 def check_path(p):
     """Check if the path exists"""
     if not os.path.exists(p):
@@ -63,11 +93,20 @@ def print_help(err=''):
               help='Execute all universes')
 @click.option('--thru', default=-1, help='Run until this universe number')
 @click.option('--jobs', default=1, help='The number of universes that can be running at a time.')
-@click.option('--batch_size', default=0, help='The approximate number of universes a processor will run in a row.')
+@click.option('--batch_size', default=0, help='Has no effect, as universes now start one at a time. Kept for compatibility.')
 @click.option('--dir', 'folder', help='Multiverse directory',
               default='./multiverse', show_default=True)
 @click.option('--cover', is_flag=True, show_default=True, default=False, help="Whether to run the min cover as a sanity check")
-def run(folder, run_all, num, thru, jobs, batch_size, cover):
+@click.option('--where', multiple=True,
+              help='Only run the universes where a decision takes an option, for example model=glm. Can be repeated.')
+@click.option('--check-syntax', is_flag=True, default=False,
+              help='Parse the universes first, and do not run those with syntax errors.')
+@click.option('--preload', multiple=True,
+              help='Run Python or R universes in long-lived workers that load this module or package once. Can be repeated.')
+@click.option('--fork', is_flag=True, default=False,
+              help='Run the blocks that Python universes share once, and fork where they diverge.')
+def run(folder, run_all, num, thru, jobs, batch_size, cover, where, check_syntax,
+        preload, fork):
     """ Execute the generated universe scripts.
 
     Run all universes: boba run --all
@@ -75,12 +114,24 @@ def run(folder, run_all, num, thru, jobs, batch_size, cover):
     Run a single universe, for example universe_1: boba run 1
 
     Run a range of universes for example 1 through 5: boba run 1 --thru 5
+
+    Run all universes where the model is glm: boba run --where model=glm
     """
 
+    recover_dir(folder)
     check_path(folder)
 
-    df = pd.read_csv(folder + '/summary.csv')
-    num_universes = df.shape[0]
+    num_universes, _ = peek_summary(folder)
+
+    # the same decision can be given more than once, to allow any of its options
+    conditions = {}
+    for w in where:
+        name, sep, option = w.partition('=')
+        if not sep:
+            print_help('The where parameter must look like decision=option.')
+        conditions.setdefault(name, []).append(option)
+    if len(conditions) and num == -1:
+        run_all = True
 
     if not run_all and not cover:
         if thru == -1:
@@ -93,17 +144,22 @@ def run(folder, run_all, num, thru, jobs, batch_size, cover):
             print_help(f'There are only {num_universes} universes.')
             
     if cover:
-        min_decs = get_min_decisions(df)
-        print(f"Running minimum universes, {len(min_decs)} of {len(df)}")
-        br = BobaRun(folder, jobs, batch_size)
+        min_decs = get_min_decisions(read_decision_matrix(folder))
+        print(f"Running minimum universes, {len(min_decs)} of {num_universes}")
+        br = BobaRun(folder, jobs, batch_size, check_syntax,
+                     preload or None, fork)
         universe_nums = list(min_decs.keys())
         br.run_multiverse(universe_nums)
         app_error_dashboard.data_folder = osp.realpath(folder)
         app_error_dashboard.aggr_error = DebugMultiverse(app_error_dashboard.data_folder)
         app_error_dashboard.run(host='0.0.0.0', port=f'8060')
     else:
-        br = BobaRun(folder, jobs, batch_size)
-        br.run_from_cli(run_all, num, thru)
+        br = BobaRun(folder, jobs, batch_size, check_syntax,
+                     preload or None, fork)
+        try:
+            br.run_from_cli(run_all, num, thru, conditions)
+        except KeyError as e:
+            print_help(e.args[0])
 
 
 @click.command()
@@ -127,23 +183,45 @@ def merge(pattern, base, out, delimiter):
     CSVMerger(pattern, base, out, delimiter).main()
 
 
+@click.command()
+@click.option('--dir', 'folder', help='Multiverse directory',
+              default='./multiverse', show_default=True)
+def gc(folder):
+    """Delete the previous outputs left behind by compile and run.
+
+    Compiling and running move the old multiverse and logs aside, and delete
+    them in the background. This removes whatever is left, for example after
+    an interrupted compile. Do not run it while a compile is in progress.
+    """
+
+    # finish a swap that a crash interrupted, rather than delete the new multiverse
+    recover_dir(folder)
+    stale = find_stale_dirs(folder) + \
+        find_stale_dirs(osp.join(folder, DIR_LOG))
+    for d in stale:
+        click.echo('Removing {}'.format(d))
+        shutil.rmtree(d, ignore_errors=True)
+    click.echo('Removed {} folders.'.format(len(stale)))
+
+
 def diff_helper(universe_path):
     universe_path = osp.realpath(universe_path)
     print(universe_path)
     dir_code = osp.dirname(universe_path)
-    parser_pickle_path = osp.join(dir_code, '.boba_parser', 'parser.pickle')
-    if not osp.exists(parser_pickle_path):
+    ps = load_parser(osp.dirname(dir_code))
+    if ps is None:
         print('Cached boba parser does not exist. Could not run bdiff')
         return
-    with open(parser_pickle_path, 'rb') as f:
-        ps = pickle.load(f)
+    if not ps.virtual and not ps.packed and not osp.exists(universe_path):
+        print('Universe "{}" does not exist.'.format(universe_path))
+        return
     print('Calculating Diff ...')
     template_diff_view = TemplateDiffView(ps, universe_path)
     return template_diff_view
 
 
 @click.command()
-@click.argument('universe_path', type=click.Path(exists=True))
+@click.argument('universe_path', type=click.Path())
 @click.option('--port', default=8080, show_default=True,
               help='The port to bind the server to')
 @click.option('--host', default='0.0.0.0', show_default=True,
@@ -181,8 +259,10 @@ def main():
 
 
 main.add_command(compile)
+main.add_command(count)
 main.add_command(run)
 main.add_command(merge)
+main.add_command(gc)
 main.add_command(diff_gui, "diff")
 main.add_command(error_aggr_gui, "error")
 
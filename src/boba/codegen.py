@@ -0,0 +1,526 @@
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import List, Tuple, Dict
+
+from .codeparser import Chunk, BlockCode
+from .constraintparser import ConstraintParser
+
+
+@dataclass
+class History:
+    """
+    A class for keeping track of the choices made in each universe.
+
+    path: index of the code path.
+    filename: file name of the universe.
+    decisions: placeholder variables and the options they took.
+    skipped: nodes that are skipped.
+    blocks: the layout of code blocks in the universe.
+    """
+    path: int
+    filename: str = ''
+    decisions: List[DecRecord] = field(default_factory=lambda: [])
+    skipped: List = field(default_factory=lambda: [])
+    blocks: List[BlockCode] = field(default_factory=lambda: [])
+
+    @property
+    def decision_dict(self) -> Dict[str, Tuple[str, int]]:
+        return {dec_record.parameter: (dec_record.option, dec_record.idx) for dec_record in self.decisions}
+
+
+@dataclass
+class DecRecord:
+    """ A class for what options a parameter took. """
+    parameter: str = ''
+    option: str = ''
+    idx: int = -1
+
+
+@dataclass
+class Step:
+    """
+    A chunk on a code path, prepared for code generation.
+
+    node: the node the chunk belongs to.
+    code: the static code preceding the placeholder variable.
+    variable: the placeholder variable, if any.
+    lines: the number of line breaks in code.
+    constraints: keys of the constraints attached to the node.
+    new_block: whether the chunk starts a new block in the layout.
+    """
+    node: str
+    code: str
+    variable: str = ''
+    lines: int = 0
+    constraints: List[str] = field(default_factory=lambda: [])
+    new_block: bool = False
+
+
+@dataclass
+class CodePath:
+    """
+    A code path, prepared for code generation.
+
+    index: index of the code path.
+    steps: the chunks on the path.
+    blocks: the block layout of the path, one BlockCode template per block.
+    env: the environment for evaluating constraints before any choice is
+        made on the path.
+    lookahead: the checks to run after a decision is made, keyed by the
+        decision, or None for checks that do not read any decision. Each check
+        is (step, variable, constraints): if variable is set, step is the last
+        chunk where the variable is surely expanded, and the check fails if
+        none of its options is feasible; otherwise, the check fails if the
+        chunk at step would abort.
+    """
+    index: int
+    steps: List[Step] = field(default_factory=lambda: [])
+    blocks: List[BlockCode] = field(default_factory=lambda: [])
+    env: Dict = field(default_factory=lambda: {})
+    lookahead: Dict = field(default_factory=lambda: {})
+
+
+def get_block_changes(path: List[Tuple[str, Chunk]]) -> List[Tuple[str, int, int]]:
+    """
+    Find where each block of the layout starts and ends on a code path.
+    Consecutive chunks of a node are merged, unless the chunk before carries a
+    placeholder variable.
+
+    :param path: the code path, as a list of (node, chunk).
+    :return: a list of (node, start, end) in chunk indices.
+    """
+    path_block_changes = []
+    cur_block_name = path[0][0]
+    cur_block_start = 0
+    cur_var = path[0][1].variable
+    for ind, path_step in enumerate(path[1:]):
+        if path_step[0] == cur_block_name and not (cur_var == ''):
+            continue
+        else:
+            path_block_changes.append((cur_block_name, cur_block_start, ind+1))
+            cur_block_name = path_step[0]
+            cur_block_start = ind + 1
+        cur_var = path_step[1].variable
+    path_block_changes.append((cur_block_name, cur_block_start, len(path)))
+    return path_block_changes
+
+
+class CodeGenerator:
+    """
+    Generate the code of universes.
+
+    Everything that does not depend on the choices is done once up front: each
+    code path is turned into a list of steps, and every option of every
+    decision is rendered to a string. A universe is then assembled with a
+    single join over the pieces collected along its branch.
+
+    Constraints are evaluated against an environment that maps each parameter
+    to its chosen option. The environment is updated in place as the search
+    makes and undoes choices, rather than rebuilt for every check.
+
+    With forward checking, the constraints that become decidable after a
+    choice are evaluated right away, so a branch is abandoned as soon as a
+    later decision has no feasible option or a later block is bound to abort,
+    instead of when the search gets there.
+    """
+
+    def __init__(self, paths: List[List[Tuple[str, Chunk]]], dec_parser,
+                 constraints, add_paren=False, forward_check=True):
+        """
+        :param paths: the code paths, each a list of (node, chunk).
+        :param dec_parser: the decision parser holding the options.
+        :param constraints: the constraints, keyed by node or option.
+        :param add_paren: whether to wrap options in parenthesis.
+        :param forward_check: whether to prune dead branches early.
+        """
+        self.constraints = constraints
+        self.decisions = dec_parser.get_decs()
+        self.forward_check = forward_check
+
+        # how much work the search did: chunks walked, branches abandoned by
+        # forward checking, and branches that reached a failed constraint
+        self.stats = {'steps': 0, 'pruned': 0, 'aborted': 0}
+
+        # render the options once, as (code, line breaks, value)
+        self.options: Dict[str, List[Tuple[str, int, str]]] = {}
+        for dec in dec_parser.discrete_decisions:
+            self.options[dec] = [
+                (code, code.count('\n'), value) for code, value in
+                dec_parser.render_options(dec, add_paren=add_paren)]
+
+        self.paths = [self._prepare_path(i, p) for i, p in enumerate(paths)]
+
+    def _prepare_path(self, idx, path) -> CodePath:
+        """ Turn a code path into steps and a block layout. """
+        cp = CodePath(idx)
+        starts = set()
+        for name, start, end in get_block_changes(path):
+            cp.blocks.append(BlockCode(dec_name=name.split(':')[0],
+                                       opt_name=name.split(':')[-1]))
+            starts.add(start)
+
+        for i, (nd, chunk) in enumerate(path):
+            names = [n for n in (nd, nd.split(':')[0]) if n in self.constraints]
+            cp.steps.append(Step(nd, chunk.code, chunk.variable,
+                                 chunk.code.count('\n'), names,
+                                 i > 0 and i in starts))
+
+        # for ordinary blocks, the parameter is the node itself; block
+        # parameters take the actual option, and unmade decisions have value
+        # None and index -1
+        for nd, _ in path:
+            cp.env[nd.split(':')[0]] = nd.split(':')[-1]
+        for d in self.decisions:
+            cp.env[d] = None
+            cp.env[ConstraintParser.make_index_var(d)] = -1
+
+        self._prepare_lookahead(cp)
+        return cp
+
+    def _prepare_lookahead(self, cp):
+        """
+        Find the constraints on a code path that can be decided ahead of time.
+
+        A constraint can be decided once all the decisions it reads are made,
+        provided that every other name it reads is a block on the path that is
+        never skipped, because those stay the same along the path.
+        """
+        # parameters of the nodes that might be skipped
+        skippable = set(st.node.split(':')[0] for st in cp.steps
+                        if any(self.constraints[n].skip for n in st.constraints))
+        index_vars = set(ConstraintParser.make_index_var(d)
+                         for d in self.decisions)
+
+        def decidable(key):
+            c = self.constraints[key]
+            return all(n in cp.env and n not in skippable for n in c.names
+                       if n not in c.decisions and n not in index_vars)
+
+        def add(check, keys):
+            triggers = set(d for k in keys for d in self.constraints[k].decisions)
+            for d in triggers or [None]:
+                cp.lookahead.setdefault(d, []).append(check)
+
+        # a later chunk aborts if its first failed constraint is not skippable;
+        # the chunks of a node share the outcome, so check the first one
+        seen = set()
+        for i, st in enumerate(cp.steps):
+            if st.node in seen:
+                continue
+            seen.add(st.node)
+            keys = []
+            for n in st.constraints:
+                if not decidable(n):
+                    break
+                keys.append(n)
+            if any(not self.constraints[n].skip for n in keys):
+                add((i, '', keys), keys)
+
+        # a decision is surely expanded if it is in a node that is never
+        # skipped, unless the branch aborts before
+        last = {}
+        for i, st in enumerate(cp.steps):
+            v = st.variable
+            if v in self.options and \
+                    st.node.split(':')[0] not in skippable:
+                last[v] = i
+        for v, i in last.items():
+            index_var = ConstraintParser.make_index_var(v)
+            keys = ['{}:{}'.format(index_var, k)
+                    for k in range(len(self.options[v]))]
+            if all(k in self.constraints and decidable(k) for k in keys):
+                add((i, v, keys), keys)
+
+    def _is_feasible(self, cp, dec, i, chosen, env):
+        """
+        Run the forward checks triggered by a decision.
+
+        :param cp: the code path.
+        :param dec: the decision just made, or None at the start of the path.
+        :param i: the chunk where the search continues.
+        :param chosen: the decisions made so far.
+        :param env: the environment for evaluating constraints.
+        :return: False if the branch cannot produce any universe.
+        """
+        constraints = self.constraints
+        for j, v, keys in cp.lookahead.get(dec, ()):
+            if j < i or v in chosen:
+                continue
+            if v:
+                # a later decision with no feasible option
+                if not any(not all(d in chosen for d in constraints[k].decisions)
+                           or constraints[k].evaluate(env) for k in keys):
+                    return False
+            else:
+                # a later chunk that will abort
+                for k in keys:
+                    c = constraints[k]
+                    if not all(d in chosen for d in c.decisions):
+                        break
+                    if not c.evaluate(env):
+                        if not c.skip:
+                            return False
+                        break
+        return True
+
+    def _close_block(self, cp, i, lines):
+        tmpl = cp.blocks[i]
+        return BlockCode(dec_name=tmpl.dec_name, opt_name=tmpl.opt_name,
+                         code_length=lines)
+
+    def get_max_branches(self, idx):
+        """
+        An upper bound of the number of options at the first decision on a
+        code path, or 1 if the path has no decision.
+        """
+        n = [len(self.options[st.variable]) for st in self.paths[idx].steps
+             if st.variable and not st.variable.startswith('_')]
+        return max(n) if len(n) else 1
+
+    def count_path(self, idx, first=None):
+        """
+        Count the universes on a code path without generating them.
+
+        This is the same search as iter_path, memoized on the chunk and on the
+        part of the environment that the rest of the path can observe: the
+        options of the decisions read by later constraints, whether each later
+        variable is decided, and which blocks are skipped. Two branches that
+        agree on these produce the same number of universes, so the count is
+        exact while the search only visits each distinct state once.
+
+        :param idx: the index of the code path.
+        :param first: if set, only count this branch of the first decision.
+        :return: the number of universes.
+        """
+        cp = self.paths[idx]
+        steps = cp.steps
+        n_steps = len(steps)
+        constraints = self.constraints
+        options = self.options
+        env = dict(cp.env)
+        missing = object()
+
+        # the names that the path can observe from each chunk onwards
+        observed = [()] * (n_steps + 1)
+        names = set()
+        for i in range(n_steps - 1, -1, -1):
+            st = steps[i]
+            for n in st.constraints:
+                names.update(constraints[n].names)
+            v = st.variable
+            if v in options:
+                index_var = ConstraintParser.make_index_var(v)
+                names.add(index_var)
+                for k in range(len(options[v])):
+                    key = '{}:{}'.format(index_var, k)
+                    if key in constraints:
+                        names.update(constraints[key].names)
+            observed[i] = tuple(sorted(names))
+
+        memo = {}
+
+        def count(i, first):
+            key = (i,) + tuple(env.get(n, missing) for n in observed[i])
+            if first is None and key in memo:
+                return memo[key]
+
+            res = 0
+            popped = []
+            while True:
+                if i >= n_steps:
+                    res = 1 if first is None or first == 0 else 0
+                    break
+
+                st = steps[i]
+                failed = None
+                for n in st.constraints:
+                    if not constraints[n].evaluate(env):
+                        failed = n
+                        break
+                if failed is not None:
+                    if not constraints[failed].skip:
+                        break
+                    name = st.node.split(':')[0]
+                    if name in env:
+                        popped.append((name, env.pop(name)))
+                    i += 1
+                    continue
+
+                v = st.variable
+                index_var = ConstraintParser.make_index_var(v)
+                if v and not v.startswith('_') and env[index_var] == -1:
+                    branches = [
+                        (k, value) for k, (_, _, value) in enumerate(options[v])
+                        if '{}:{}'.format(index_var, k) not in constraints or
+                        constraints['{}:{}'.format(index_var, k)].evaluate(env)]
+                    if first is not None:
+                        branches = branches[first:first + 1]
+                    for k, value in branches:
+                        env[v] = value
+                        env[index_var] = k
+                        res += count(i + 1, None)
+                    env[v] = None
+                    env[index_var] = -1
+                    break
+                i += 1
+
+            for name, value in reversed(popped):
+                env[name] = value
+            if first is None:
+                memo[key] = res
+            return res
+
+        return count(0, first)
+
+    def iter_path(self, idx, first=None, render=True, fixed=None):
+        """
+        Generate the code of all universes on a code path.
+
+        This is a depth-first search over the decisions on the path, driven by
+        an explicit stack. The code pieces, decisions, skipped nodes and block
+        layout of the current branch live in shared lists, and every stack
+        frame remembers how long each list was, so backtracking is a matter of
+        trimming the lists back.
+
+        Nothing is chosen before the first decision, so the walk up to that
+        point is the same for every universe on the path. Passing first splits
+        the path there: only the first-th feasible option of that decision is
+        followed.
+
+        :param idx: the index of the code path.
+        :param first: if set, only follow this branch of the first decision.
+        :param render: if False, do not assemble the code.
+        :param fixed: if set, a dict from decision to option index, and only
+            these options are followed.
+        :return: a generator of (history, code), where code still contains the
+            reserved keywords, or is None if render is False.
+        """
+        cp = self.paths[idx]
+        steps = cp.steps
+        n_steps = len(steps)
+        constraints = self.constraints
+        options = self.options
+        env = dict(cp.env)
+        forward_check = self.forward_check and cp.lookahead
+        stats = self.stats
+
+        parts = []
+        decisions = []
+        skipped = []
+        chosen = {}
+        blocks = []
+
+        # the frame is: step, block, #parts, #decisions, #skipped, #blocks,
+        # line count at the start of the block, line count, choice
+        stack = [(0, 0, 0, 0, 0, 0, 0, 0, None)]
+        while stack:
+            i, b, n_parts, n_decs, n_skipped, n_blocks, block_start, lines, \
+                choice = stack.pop()
+
+            # backtrack to the state of this frame
+            del parts[n_parts:]
+            for d in decisions[n_decs:]:
+                del chosen[d.parameter]
+                env[d.parameter] = None
+                env[ConstraintParser.make_index_var(d.parameter)] = -1
+            del decisions[n_decs:]
+            restored = skipped[n_skipped:]
+            del skipped[n_skipped:]
+            for nd in restored:
+                if nd not in skipped:
+                    env[nd.split(':')[0]] = nd.split(':')[-1]
+            del blocks[n_blocks:]
+            if choice is not None:
+                dec, opt, opt_lines = choice
+                decisions.append(dec)
+                chosen[dec.parameter] = dec.idx
+                env[dec.parameter] = dec.option
+                env[ConstraintParser.make_index_var(dec.parameter)] = dec.idx
+                parts.append(opt)
+                lines += opt_lines
+
+            if forward_check and not self._is_feasible(
+                    cp, choice[0].parameter if choice else None, i, chosen,
+                    env):
+                stats['pruned'] += 1
+                continue
+
+            # walk down the path until the next branching point
+            start = i
+            while True:
+                if i >= n_steps:
+                    last = self._close_block(cp, b, lines - block_start + 1)
+                    if first is None or first == 0:
+                        yield History(idx, '', list(decisions), list(skipped),
+                                      blocks + [last]), \
+                            ''.join(parts) if render else None
+                    break
+
+                st = steps[i]
+                if st.new_block:
+                    blocks.append(self._close_block(cp, b, lines - block_start))
+                    b += 1
+                    block_start = lines
+
+                # check if the node has constraints attached to it
+                failed = None
+                for n in st.constraints:
+                    if not constraints[n].evaluate(env):
+                        failed = n
+                        break
+                if failed is not None:
+                    if not constraints[failed].skip:
+                        # abort codegen
+                        stats['aborted'] += 1
+                        break
+                    # skip the node and continue
+                    skipped.append(st.node)
+                    env.pop(st.node.split(':')[0], None)
+                    i += 1
+                    continue
+
+                parts.append(st.code)
+                lines += st.lines
+                v = st.variable
+                if v == '':
+                    pass
+                elif v in chosen:
+                    # use the previous value
+                    opt, opt_lines, _ = options[v][chosen[v]]
+                    parts.append(opt)
+                    lines += opt_lines
+                elif v.startswith('_'):
+                    # reserved keywords are filled in later
+                    parts.append('{{' + v + '}}')
+                else:
+                    # expand the decision
+                    frame = (i + 1, b, len(parts), len(decisions),
+                             len(skipped), len(blocks), block_start, lines)
+                    branches = []
+                    index_var = ConstraintParser.make_index_var(v)
+                    for k, (opt, opt_lines, value) in enumerate(options[v]):
+                        # check if the option has constraints attached to it
+                        # always check by index, rather than actual value
+                        if fixed is not None and fixed.get(v) != k:
+                            continue
+                        key = '{}:{}'.format(index_var, k)
+                        if key in constraints and \
+                                not constraints[key].evaluate(env):
+                            # constraint met, abort
+                            continue
+                        dec = DecRecord(v, value, k)
+                        branches.append(frame + ((dec, opt, opt_lines),))
+
+                    if first is not None:
+                        # only follow one branch of the first decision
+                        branches = branches[first:first + 1]
+                        first = None
+
+                    # visit the options in order
+                    stack.extend(reversed(branches))
+                    break
+
+                i += 1
+            stats['steps'] += i - start + 1
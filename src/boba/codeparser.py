@@ -5,7 +5,8 @@ from dataclasses import dataclass, field
 from typing import List, Dict
 import json
 
-from .blocksyntaxparser import BlockSyntaxParser, ParseError
+from .blocksyntaxparser import ParseError
+from . import tokenizer
 
 
 @dataclass
@@ -170,7 +171,7 @@ class CodeParser:
 		self.all_blocks: List[BlockCode] = [] # for direct ordered block to line mapping
 		self.order = []
 		for i, line in enumerate(f):
-			if BlockSyntaxParser.can_parse(line):
+			if tokenizer.is_block(line):
 				# end of the previous block
 				bl.chunks.append(Chunk('', code))
 				bl.code_str = ''.join(block_code_lines)
@@ -179,7 +180,7 @@ class CodeParser:
 				self._add_block(bl)
 
 				# parse the metadata and create a new block
-				bp_id, par, opt, cond = BlockSyntaxParser(line).parse()
+				bp_id, par, opt, cond = tokenizer.parse_block(line)
 				bl = Block(bp_id, par, opt, [], block_prefix=line)
 
 				# store inline constraints, if any
@@ -188,7 +189,7 @@ class CodeParser:
 			else:
 				# match decision variables
 				try:
-					vs, boba_vars, codes = dec_parser.parse_code(line)
+					vs, boba_vars, codes = dec_parser.tokenize_code(line)
 					if len(vs):
 						# store inline variables
 						self.used_vars.update(boba_vars)
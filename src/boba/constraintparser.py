@@ -1,19 +1,54 @@
 # -*- coding: utf-8 -*-
 
 import json
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from types import CodeType
+from typing import List
 from .baseparser import ParseError
-from .conditionparser import ConditionParser, TokenType
+from .conditionparser import TokenType
+from . import tokenizer
 
 
 @dataclass
 class Constraint:
+    """
+    A constraint attached to a block or an option.
+
+    condition: the condition as python code.
+    decisions: the placeholder variables the condition reads.
+    code: the compiled condition. Code objects cannot be pickled, so it is
+        dropped when pickling and compiled again when unpickling.
+    """
     block: str = ''
     variable: str = ''
     option: str = ''
     index: int = -1
     skip: bool = False
     condition: str = ''
+    decisions: List[str] = field(default_factory=lambda: [])
+    code: CodeType = field(default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.code is None and self.condition:
+            self.code = compile(self.condition, '<constraint>', 'eval')
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['code'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__post_init__()
+
+    def evaluate(self, env):
+        """ Evaluate the condition, given a dict of decisions and options. """
+        return eval(self.code, env)
+
+    @property
+    def names(self):
+        """ All names the condition reads. """
+        return self.code.co_names if self.code else ()
 
 
 class ConstraintParser:
@@ -207,16 +242,26 @@ class ConstraintParser:
 
         # check if the code has syntax error
         try:
-            eval(recon, {})
+            compile(recon, '<constraint>', 'eval')
         except SyntaxError:
             msg = 'In parsing condition:\n\t' + cond + \
                   '\nSyntax Error: invalid syntax'
             raise ParseError(msg)
-        except NameError:
-            pass
 
         return recon
 
+    @staticmethod
+    def _get_decisions_read(constraint, decs):
+        """ Find the placeholder variables that the condition reads, either by
+        value or by index. """
+        res = []
+        for n in constraint.names:
+            v = n[len(ConstraintParser.make_index_var('')):] \
+                if n.startswith(ConstraintParser.make_index_var('')) else n
+            if v in decs and v not in res:
+                res.append(v)
+        return res
+
     def _infer_procedural_deps(self, c, block, variable, cond):
         """ Infer procedural edges from parsed condition """
         # skip constraints added by us, for example links
@@ -277,7 +322,7 @@ class ConstraintParser:
 
             # read condition
             cond = ConstraintParser._read_required(c, 'condition')
-            code, parsed_decs = ConditionParser(cond).parse()
+            code, parsed_decs = tokenizer.parse_condition(cond)
             if len(parsed_decs) % 2 == 1:
                 ConstraintParser._throw('Binary operator expected', c)
             ConstraintParser._verify_condition_vars(parsed_decs, decs, bls, c)
@@ -290,6 +335,8 @@ class ConstraintParser:
 
             # save
             constraint = Constraint(block, param, opt, idx, skip, recon)
+            constraint.decisions = ConstraintParser._get_decisions_read(
+                constraint, decs)
             key = ConstraintParser._create_key(constraint)
             self.constraints[key] = constraint
 
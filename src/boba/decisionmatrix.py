@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+
+import array
+
+import numpy as np
+import pandas as pd
+
+
+class DecisionMatrix:
+    """
+    The option every universe takes in every decision, as an integer array of
+    universes by decisions. A code indexes the option table of its decision,
+    and -1 means the universe does not make the decision. Options are compared
+    as strings, as they appear in the summary.
+    """
+
+    def __init__(self, names, codes, options):
+        self.names = list(names)
+        self.codes = codes
+        self.options = [list(opts) for opts in options]
+        self._columns = {n: j for j, n in enumerate(self.names)}
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    @staticmethod
+    def from_rows(names, rows, options=None):
+        """
+        Encode rows of decision values.
+
+        :param names: the decision names, one per column.
+        :param rows: the values, one row per universe. An empty or missing
+            value means the decision is not made.
+        :param options: the declared options of some decisions, by name, so
+            that their codes follow the declared order.
+        """
+        builder = DecisionMatrixBuilder(names, options)
+        for row in rows:
+            builder.add(row)
+        return builder.build()
+
+    @staticmethod
+    def load(fn):
+        """ Load the matrix from a .npz file """
+        with np.load(fn) as data:
+            names = [str(n) for n in data['columns']]
+            options = [data['options_{}'.format(j)].tolist()
+                       for j in range(len(names))]
+            return DecisionMatrix(names, data['codes'], options)
+
+    def save(self, fn, **extra):
+        """ Save the matrix, and any extra arrays, to a .npz file """
+        res = {'columns': np.array(self.names, dtype=str), 'codes': self.codes}
+        for j, opts in enumerate(self.options):
+            res['options_{}'.format(j)] = np.array(opts, dtype=str)
+        res.update(extra)
+        np.savez(fn, **res)
+
+    def replace_columns(self, names, rows):
+        """
+        A copy of the matrix where some columns are encoded again.
+
+        :param names: the names of the columns to replace.
+        :param rows: their new values, as in from_rows.
+        """
+        new = DecisionMatrix.from_rows(names, rows)
+        codes = self.codes.astype(
+            np.promote_types(self.codes.dtype, new.codes.dtype), order='F')
+        options = list(self.options)
+        for j, name in enumerate(names):
+            k = self._columns[name]
+            codes[:, k] = new.codes[:, j]
+            options[k] = new.options[j]
+        return DecisionMatrix(self.names, codes, options)
+
+    def get_code(self, name, option):
+        """ The code of an option, or -1 if the decision has no such option """
+        try:
+            return self.options[self._columns[name]].index(str(option))
+        except ValueError:
+            return -1
+
+    def column(self, name):
+        """ The codes of a decision, one per universe """
+        return self.codes[:, self._columns[name]]
+
+    def mask(self, name, *options):
+        """ Whether each universe takes any of the options in a decision """
+        codes = [self.get_code(name, opt) for opt in options]
+        return np.isin(self.column(name), [c for c in codes if c >= 0])
+
+    def select(self, conditions):
+        """
+        Select the universes that satisfy all conditions.
+
+        :param conditions: a dict from decision name to an option, or a list
+            of options, for example {'outliers': 2}.
+        :return: a sorted array of universe ids.
+        """
+        res = np.ones(len(self), dtype=bool)
+        for name, opts in conditions.items():
+            opts = opts if isinstance(opts, (list, tuple, set)) else [opts]
+            res &= self.mask(name, *opts)
+        return np.flatnonzero(res) + 1
+
+    def get_options(self, name, universes=None):
+        """
+        The options a decision takes, in the order of its option table.
+
+        :param universes: only consider these universe ids.
+        """
+        codes = self.column(name)
+        if universes is not None:
+            codes = codes[np.asarray(list(universes), dtype=np.int64) - 1]
+        opts = self.options[self._columns[name]]
+        return [opts[c] for c in np.unique(codes) if c >= 0]
+
+    def get_decisions(self, universe_id):
+        """ The options a universe takes, by decision name """
+        row = self.codes[universe_id - 1]
+        return {n: self.options[j][c] for j, (n, c) in
+                enumerate(zip(self.names, row)) if c >= 0}
+
+    def estimate(self, values):
+        """
+        Estimate a positive quantity, such as the run time, for the universes
+        where it is unknown from those where it is known. Each option is
+        assumed to scale the quantity by a constant factor, fit as the mean
+        log ratio over the known universes that take the option.
+
+        :param values: one value per universe, NaN if it is unknown.
+        :return: the known values, and the estimates for the rest. If no value
+            is known, everything stays NaN.
+        """
+        values = np.asarray(values, dtype=float)
+        known = np.isfinite(values)
+        res = values.copy()
+        if not known.any():
+            return res
+
+        logs = np.log(np.maximum(values[known], 1e-3))
+        est = np.full(len(self), logs.mean())
+        for j in range(len(self.names)):
+            # shift the codes so that "not made" is an option of its own
+            cs = self.codes[:, j].astype(np.int64) + 1
+            width = len(self.options[j]) + 1
+            sums = np.bincount(cs[known], weights=logs - logs.mean(),
+                               minlength=width)
+            counts = np.bincount(cs[known], minlength=width)
+            effect = np.divide(sums, counts, out=np.zeros(width),
+                               where=counts > 0)
+            est += effect[cs]
+        res[~known] = np.exp(est[~known])
+        return res
+
+    def to_frame(self, na_value=None):
+        """
+        Convert to a data frame of categorical columns. The options are
+        converted to numbers if they all are, as reading the summary CSV would.
+        Decisions that are not made are NaN, or na_value if it is given.
+        """
+        res = {}
+        for j, name in enumerate(self.names):
+            cats = pd.Index(self.options[j], dtype=object)
+            try:
+                num = pd.Index(pd.to_numeric(cats))
+                cats = num if num.is_unique else cats
+            except ValueError:
+                pass
+
+            cs = self.codes[:, j]
+            if na_value is not None and (cs < 0).any():
+                cs = np.where(cs < 0, len(cats), cs)
+                cats = cats.append(pd.Index([na_value]))
+            res[name] = pd.Categorical.from_codes(cs, categories=cats)
+        return pd.DataFrame(res)
+
+
+class DecisionMatrixBuilder:
+    """ Encode the rows of a decision matrix one at a time """
+
+    def __init__(self, names, options=None):
+        """ The arguments are as in DecisionMatrix.from_rows """
+        options = options or {}
+        self.names = list(names)
+        self.size = 0
+        self.codes = array.array('i')
+        self.lookups = []
+        for name in self.names:
+            lookup = {}
+            for opt in options.get(name, []):
+                if str(opt) != '':
+                    lookup.setdefault(str(opt), len(lookup))
+            self.lookups.append(lookup)
+
+    def add(self, row):
+        """ Encode the values of a universe """
+        for j, lookup in enumerate(self.lookups):
+            value = row[j] if j < len(row) else None
+            value = '' if value is None else str(value)
+            self.codes.append(lookup.setdefault(value, len(lookup))
+                              if value != '' else -1)
+        self.size += 1
+
+    def build(self):
+        codes = np.frombuffer(self.codes, dtype=np.intc)\
+            .reshape(self.size, len(self.names))
+        tables = [list(lookup) for lookup in self.lookups]
+
+        # the codes only need to be wide enough for the largest table
+        width = max([len(t) for t in tables], default=0)
+        codes = codes.astype(np.min_scalar_type(-max(width, 1)), order='F')
+        return DecisionMatrix(self.names, codes, tables)
+
+
+class RowIndex:
+    """
+    An index from a row of codes to the universe id. Each column is a digit of
+    a mixed-radix number, where the radix of a column is its number of codes,
+    plus one for a decision that is not made. If these numbers are dense
+    enough, the index is a table addressed by the number. Otherwise, as in a
+    heavily constrained multiverse, it is a hash table of the rows, with open
+    addressing so that it stays a flat array. Either way, finding a row takes
+    constant time.
+    """
+
+    # the largest table, relative to the number of universes, though a table
+    # of up to DENSE_MIN entries is always allowed
+    DENSE_FACTOR = 4
+    DENSE_MIN = 1 << 16
+
+    # the 64-bit FNV-1a hash, applied to the codes rather than to bytes
+    _FNV_OFFSET = np.uint64(14695981039346656037)
+    _FNV_PRIME = np.uint64(1099511628211)
+
+    def __init__(self, radices, dtype, table=None, rows=None, slots=None):
+        self.radices = list(radices)
+        self.dtype = np.dtype(dtype)
+        self.table = table
+        self.rows = rows
+        self.slots = slots
+
+        self.weights = []
+        w = 1
+        for r in self.radices:
+            self.weights.append(w)
+            w *= r
+        self.size = w
+
+    @staticmethod
+    def build(codes, radices):
+        """
+        :param codes: the matrix of codes, one row per universe.
+        :param radices: the number of codes in each column.
+        """
+        idx = RowIndex([r + 1 for r in radices], codes.dtype)
+        n = codes.shape[0]
+        limit = max(RowIndex.DENSE_FACTOR * n, RowIndex.DENSE_MIN)
+        if idx.size <= limit and idx.size < 1 << 31:
+            keys = (np.asarray(codes, dtype=np.int64) + 1) @ \
+                np.array(idx.weights, dtype=np.int64)
+            idx.table = np.zeros(idx.size, dtype=np.int32)
+            idx.table[keys] = np.arange(1, n + 1, dtype=np.int32)
+        else:
+            idx.rows = np.ascontiguousarray(codes, dtype=idx.dtype)
+            idx.slots = idx._place(idx.rows)
+        return idx
+
+    @staticmethod
+    def _hash(codes):
+        """ The hash of each row of codes """
+        h = np.full(codes.shape[0], RowIndex._FNV_OFFSET, dtype=np.uint64)
+        for j in range(codes.shape[1]):
+            h ^= (codes[:, j].astype(np.int64) + 1).astype(np.uint64)
+            h *= RowIndex._FNV_PRIME
+        return h ^ (h >> np.uint64(32))
+
+    @staticmethod
+    def _place(rows):
+        """
+        Put the rows into a hash table, at most half full, whose slots hold
+        the universe ids, or 0 where they are empty. A row that collides goes
+        to the next free slot. Rows are placed in rounds, where each empty slot
+        takes the first row that probes it and the others move on.
+        """
+        n = rows.shape[0]
+        size = 1 << max(2 * n - 1, 1).bit_length()
+        mask = np.uint64(size - 1)
+        slots = np.zeros(size, dtype=np.int32)
+
+        pending = np.arange(n)
+        probe = (RowIndex._hash(rows) & mask).astype(np.int64)
+        while len(pending):
+            free = slots[probe] == 0
+            _, first = np.unique(probe[free], return_index=True)
+            placed = np.flatnonzero(free)[first]
+            slots[probe[placed]] = pending[placed] + 1
+
+            left = np.ones(len(pending), dtype=bool)
+            left[placed] = False
+            pending = pending[left]
+            probe = (probe[left] + 1) & (size - 1)
+        return slots
+
+    @staticmethod
+    def load(fn):
+        with np.load(fn) as data:
+            return RowIndex(data['radices'], data['dtype'].item(),
+                            **{k: data[k] for k in ('table', 'rows', 'slots')
+                               if k in data.files})
+
+    def save(self, fn):
+        res = {'radices': np.array(self.radices),
+               'dtype': np.array(self.dtype.str)}
+        for k in ('table', 'rows', 'slots'):
+            if getattr(self, k) is not None:
+                res[k] = getattr(self, k)
+        np.savez(fn, **res)
+
+    def find(self, row):
+        """ The universe id of a row of codes, or None if there is none """
+        if self.table is not None:
+            key = sum((int(c) + 1) * w for c, w in zip(row, self.weights))
+            uid = self.table[key]
+            return int(uid) if uid else None
+
+        # the same hash as _hash, without the overhead of arrays for one row
+        row = [int(c) for c in row]
+        h = int(RowIndex._FNV_OFFSET)
+        for c in row:
+            h = ((h ^ (c + 1)) * int(RowIndex._FNV_PRIME)) & ((1 << 64) - 1)
+        mask = len(self.slots) - 1
+        i = (h ^ (h >> 32)) & mask
+        while self.slots[i]:
+            uid = int(self.slots[i])
+            if self.rows[uid - 1].tolist() == row:
+                return uid
+            i = (i + 1) & mask
+        return None
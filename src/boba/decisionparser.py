@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import json
-import random
+import zlib
+import numpy as np
+from scipy import special
 from dataclasses import dataclass
 from .baseparser import ParseError, BaseParser
+from . import tokenizer
 
 
 @dataclass
@@ -53,32 +56,62 @@ class DecisionParser(BaseParser):
 
 
     @staticmethod
-    def get_within_range(function, args, distribution_range, exclusive):
-        """bind the output of the provided function within the provided range"""
-        if distribution_range[1] <= distribution_range[0]:
-            raise ValueError('max value: ' + str(distribution_range[1]) + ' is less than min value: ' + str(distribution_range[0]))
-        
-        val = function(*args)
-        while (val < distribution_range[0] or val > distribution_range[1] or
-              ((val == distribution_range[0] or val == distribution_range[1]) and exclusive)):
-            val = function(*args)
+    def get_rng(seed, name, index):
+        """
+        A generator for a sampled option of a decision. Without a seed, it is
+        seeded by the decision name, so the samples do not change when other
+        decisions are added or removed.
+
+        :param index: the position of the option, as a tuple of indices that
+            goes through any nested option lists.
+        """
+        if seed is None:
+            seed = [zlib.crc32(name.encode('utf-8'))] + list(index)
+        else:
+            # the generator only takes non-negative seeds
+            seed = seed & (2 ** 64 - 1)
+        return np.random.default_rng(seed)
 
-        return val
+    @staticmethod
+    def get_within_range(distribution_range, exclusive):
+        """check the range and, if exclusive, shrink it to exclude the ends"""
+        lo, hi = distribution_range
+        if hi <= lo:
+            raise ValueError('max value: ' + str(hi) + ' is less than min value: ' + str(lo))
+
+        if exclusive:
+            lo, hi = np.nextafter(lo, np.inf), np.nextafter(hi, -np.inf)
+        return lo, hi
+
+    @staticmethod
+    def truncated_normal(rng, count, mean, std_dev, lo, hi):
+        """
+        Sample a normal distribution truncated to [lo, hi] by inverting its
+        CDF. In the upper tail, the CDF rounds to 1, so we sample the mirrored
+        lower tail instead.
+        """
+        a, b = (lo - mean) / std_dev, (hi - mean) / std_dev
+        flip = a > 0
+        if flip:
+            a, b = -b, -a
+        u = rng.uniform(special.ndtr(a), special.ndtr(b), count)
+        z = np.clip(special.ndtri(u), a, b)
+        return mean + std_dev * (-z if flip else z)
 
     @staticmethod
-    def random_uniform(minimum, maximum, args):
-        """randomly sample a number from a uniform distribution"""
+    def random_uniform(rng, count, minimum, maximum, args):
+        """randomly sample numbers from a uniform distribution"""
         exclusive = args.get('exclusive', False)
         DecisionParser.check_var_types([minimum, maximum, exclusive], 
                         [float, float, bool], 
                         ['min', 'max', 'exclusive'])
 
-        distr_range = [minimum, maximum]
-        return DecisionParser.get_within_range(random.uniform, distr_range, distr_range, exclusive)
+        lo, hi = DecisionParser.get_within_range([minimum, maximum], exclusive)
+        return rng.uniform(lo, hi, count)
 
     @staticmethod
-    def rand_x_normal(function, args):
-        """randomly sample a number from any type of normal distribution"""
+    def rand_x_normal(rng, count, log, args):
+        """randomly sample numbers from any type of normal distribution"""
         mean = args.get('mean', 0.0)
         std_dev = args.get('std_dev', 1.0)
         exclusive = args.get('exclusive', False)
@@ -95,23 +128,30 @@ class DecisionParser(BaseParser):
         elif distribution_range and len(distribution_range) == 2:
             DecisionParser.check_var_types(distribution_range, [float, float], ['range[0]', 'range[1]'])
 
+        lo, hi = -np.inf, np.inf
         if distribution_range:
-            return DecisionParser.get_within_range(function, [mean, std_dev], distribution_range, exclusive)
-        else:
-            return function(mean, std_dev)
+            lo, hi = DecisionParser.get_within_range(distribution_range, exclusive)
+            if log:
+                if hi <= 0:
+                    raise ValueError('max value: ' + str(hi) + ' is not positive')
+                lo = np.log(lo) if lo > 0 else -np.inf
+                hi = np.log(hi)
+
+        res = DecisionParser.truncated_normal(rng, count, mean, std_dev, lo, hi)
+        return np.exp(res) if log else res
 
     @staticmethod
-    def random_lognormal(args):
-        """randomly sample a number from a lognormal distribution"""
-        return DecisionParser.rand_x_normal(random.lognormvariate, args)
+    def random_lognormal(rng, count, args):
+        """randomly sample numbers from a lognormal distribution"""
+        return DecisionParser.rand_x_normal(rng, count, True, args)
 
     @staticmethod
-    def random_normal(args):
-        """randomly sample a number from a normal distribution"""
-        return DecisionParser.rand_x_normal(random.normalvariate, args)
+    def random_normal(rng, count, args):
+        """randomly sample numbers from a normal distribution"""
+        return DecisionParser.rand_x_normal(rng, count, False, args)
 
     @staticmethod
-    def discretize(obj, discretization_method, count):
+    def discretize(obj, discretization_method, count, rng=None):
         """discretizes a continuous variable into 'count' descrete options."""
         discretization_methods = {
             'uniform': DiscretizationFn(DecisionParser.random_uniform, ['min', 'max'], ['exclusive']), 
@@ -124,7 +164,8 @@ class DecisionParser(BaseParser):
 
         method = discretization_methods[discretization_method]
         required_param_names = method.required_params
-        param_values = []
+        param_values = [rng if rng is not None else np.random.default_rng(),
+                        count]
         for param_name in required_param_names:
             try:
                 param_values.append(DecisionParser._read_json_safe(obj, param_name))
@@ -141,33 +182,29 @@ class DecisionParser(BaseParser):
 
         param_values.append(optional_params)
         fn = method.function
-        samples = []
-        for i in range(count):
-            samples.append(fn(*param_values))
-
-        return samples
+        return fn(*param_values).tolist()
 
     @staticmethod
-    def _read_discrete_options(s, allow_empty_list=False):
+    def _read_discrete_options(s, allow_empty_list=False, name='', prefix=()):
         """reads an option, converting all continuous values into discrete ones"""
         generated_res = []
         res = DecisionParser._read_options(s, allow_empty_list)
-        for val in res:
+        for i, val in enumerate(res):
             if isinstance(val, dict):
                 try:
                     sampling_method = str(DecisionParser._read_json_safe(val, "sample"))
                     count = int(DecisionParser._read_json_safe(val, "count"))
                     try:
                         seed = int(DecisionParser._read_json_safe(val, "seed"))
-                        random.seed(seed)
                     except (ParseError, TypeError):
-                        pass
+                        seed = None
 
-                    generated_res.extend(DecisionParser.discretize(val, sampling_method, count))
+                    rng = DecisionParser.get_rng(seed, name, prefix + (i,))
+                    generated_res.extend(DecisionParser.discretize(val, sampling_method, count, rng))
                 except (ParseError, TypeError):
                     raise ParseError('expected "sample" and "count" to be defined as string and int respectively in object:\n' + str(s))
             elif isinstance(val, list):
-                generated_res.append(DecisionParser._read_discrete_options(val, True))
+                generated_res.append(DecisionParser._read_discrete_options(val, True, name, prefix + (i,)))
             else:
                 generated_res.append(val)
 
@@ -219,7 +256,7 @@ class DecisionParser(BaseParser):
             var = self._check_type(DecisionParser._read_json_safe(d, 'var'),
                                    DecisionParser._is_id_token, 'id')
             value = DecisionParser._read_options(DecisionParser._read_json_safe(d, 'options'))
-            discrete_value = DecisionParser._read_discrete_options(DecisionParser._read_json_safe(d, 'options'))
+            discrete_value = DecisionParser._read_discrete_options(DecisionParser._read_json_safe(d, 'options'), name=var)
 
             # check if two variables have the same name
             if var in self.decisions:
@@ -264,22 +301,19 @@ class DecisionParser(BaseParser):
         """Get a list of decision names."""
         return [i for i in self.decisions.keys()]
 
-    def gen_code(self, template, dec_id, i_alt, add_paren=False):
+    def render_options(self, dec_id, add_paren=False):
         """
-        Replace the placeholder variable in a template chunk.
-        :param template: a chunk of code with only one placeholder
+        Render all alternatives of a decision as code.
         :param dec_id: variable ID of the decision
-        :param i_alt: which alternative
-        :return: {string, string} replaced code and the value at this parameter
+        :param add_paren: whether to wrap the value in parenthesis
+        :return: a list of {string, string}, the code to substitute in and the
+                 value at this parameter
         """
-        v = self.get_alt_discrete(dec_id, i_alt)
-
-        # assuming the placeholder var is always at the end
-        # which is true given how we chop up the chunks
-        if add_paren:
-            return template + '(' + str(v) + ')', str(v)
-        else:
-            return template + str(v), str(v)
+        res = []
+        for v in self.discrete_decisions[dec_id].value:
+            v = str(v)
+            res.append(('(' + v + ')' if add_paren else v, v))
+        return res
 
     def parse_code(self, line):
         """
@@ -344,19 +378,44 @@ class DecisionParser(BaseParser):
 
                 # parse and save definition
                 if df:
-                    try:
-                        df = json.loads('[{}]'.format(df))
-                        decision = Decision(val, df, '')
-                        if val in self.decisions:
-                            msg = 'Duplicate variable definition "{}"'
-                            raise ParseError(msg.format(val))
-                        self.decisions[val] = decision
-                        self.discrete_decisions[val] = decision
-                    except ValueError:
-                        msg = 'Cannot parse variable definition:\n{}'
-                        raise ParseError(msg.format(df))
+                    self._add_definition(val, df)
             else:
                 self._next_char()
 
         code.append(line[j:])
         return res, res_boba_var, code
+
+    def tokenize_code(self, line):
+        """
+        The same as parse_code, but with a regex tokenizer that is much faster
+        on long templates.
+        """
+        code = []
+        res = []
+        res_boba_var = []
+        j = 0
+        for start, end, val, is_dec, df in tokenizer.find_placeholders(line):
+            code.append(line[j:start])
+            res.append(val)
+            j = end
+            if is_dec:
+                res_boba_var.append(val)
+                if df:
+                    self._add_definition(val, df)
+
+        code.append(line[j:])
+        return res, res_boba_var, code
+
+    def _add_definition(self, val, df):
+        """ Parse and save the inline definition of a placeholder variable """
+        try:
+            df = json.loads('[{}]'.format(df))
+            decision = Decision(val, df, '')
+            if val in self.decisions:
+                msg = 'Duplicate variable definition "{}"'
+                raise ParseError(msg.format(val))
+            self.decisions[val] = decision
+            self.discrete_decisions[val] = decision
+        except ValueError:
+            msg = 'Cannot parse variable definition:\n{}'
+            raise ParseError(msg.format(df))
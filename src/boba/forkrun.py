@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+Run Python universes as a tree of processes that mirrors the decision tree.
+Universes on the same code path often start with the same blocks, such as
+loading and cleaning the data. Here, each distinct prefix runs once, and the
+process forks where the universes diverge, so that every child continues
+with the state of its parent and runs only its own remaining blocks.
+
+The supervisor builds the tree from the block layout of the universes and
+hands it to an executor, which is this file run as a script. Each node of
+the tree writes its output, errors and exit code to files of its own, and
+the supervisor puts together the logs of a universe from the nodes on its
+path, as they would be had it run alone.
+
+The executor only depends on the standard library.
+"""
+
+import __future__
+import ast
+import asyncio
+import atexit
+import builtins
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from .warmstart import python, wait_code, exit_code, print_error
+except ImportError:
+    # run as the executor, from the folder of this file
+    from warmstart import python, wait_code, exit_code, print_error
+
+# the compiler flags of __future__ imports, which carry over between blocks
+_FUTURE_FLAGS = 0
+for _f in __future__.all_feature_names:
+    _FUTURE_FLAGS |= getattr(__future__, _f).compiler_flag
+
+
+def available():
+    """ Whether the platform can fork, and there is a python to run """
+    return hasattr(os, 'fork') and python() is not None
+
+
+def split_script(code, boundaries):
+    """
+    Split a script where a block starts, unless that would split a statement.
+
+    :param code: the script.
+    :param boundaries: the line numbers, from 0, where the blocks start.
+    :return: a list of (line number of the first line, code), or the whole
+        script if it cannot be parsed.
+    """
+    lines = code.splitlines(keepends=True)
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return [(0, code)]
+
+    inside = set()
+    for stmt in tree.body:
+        first = min([stmt.lineno] + [d.lineno for d in
+                                     getattr(stmt, 'decorator_list', [])])
+        inside.update(range(first, stmt.end_lineno))
+
+    cuts = sorted(set(b for b in boundaries
+                      if 0 < b < len(lines) and b not in inside))
+    edges = [0] + cuts + [len(lines)]
+    return [(a, ''.join(lines[a:b])) for a, b in zip(edges, edges[1:])]
+
+
+def _new_node(start, code, filename, parent):
+    return {'start': start, 'code': code, 'filename': filename,
+            'parent': parent, 'children': [], 'ends': []}
+
+
+def build_tree(universes):
+    """
+    Merge the universes into a tree, where the children of a node continue
+    its code in different ways, and a chain of nodes without branches is a
+    single node.
+
+    :param universes: a list of (universe id, file name, segments), where
+        segments is the result of split_script.
+    :return: a list of nodes, the root first. A node is a dict of the line
+        number where its code starts, its code, the file name of its first
+        universe, its parent, its children, and the universes that end there.
+    """
+    nodes = [_new_node(0, '', '', None)]
+    index = {}
+    for uid, filename, segments in universes:
+        cur = 0
+        for start, code in segments:
+            key = (cur, start, code)
+            if key not in index:
+                index[key] = len(nodes)
+                nodes.append(_new_node(start, code, filename, cur))
+                nodes[cur]['children'].append(index[key])
+            cur = index[key]
+        nodes[cur]['ends'].append(uid)
+
+    # fold each node without branches into its only child
+    res = []
+    stack = [(0, None)]
+    while len(stack):
+        i, parent = stack.pop()
+        node = dict(nodes[i], parent=parent)
+        parts = [node['code']]
+        while len(node['children']) == 1 and not len(node['ends']):
+            child = nodes[node['children'][0]]
+            parts.append(child['code'])
+            node['children'], node['ends'] = child['children'], child['ends']
+            if not node['filename']:
+                node['start'], node['filename'] = child['start'], \
+                    child['filename']
+        node['code'] = ''.join(parts)
+
+        k = len(res)
+        res.append(node)
+        if parent is not None:
+            res[parent]['children'].append(k)
+        stack.extend((c, k) for c in reversed(node['children']))
+        node['children'] = []
+    return res
+
+
+class ForkTree:
+    """ The supervisor side of the executor, to use from an event loop """
+
+    def __init__(self, nodes, cwd, jobs):
+        self.nodes = nodes
+        self.cwd = cwd
+        self.jobs = jobs
+        self.folder = None
+        self.proc = None
+        self.status = None
+        self.done = set()
+
+        self._ends = {}
+        for i, node in enumerate(nodes):
+            for uid in node['ends']:
+                self._ends[uid] = i
+
+    @property
+    def returncode(self):
+        return None if self.proc is None else self.proc.returncode
+
+    async def start(self):
+        self.folder = tempfile.mkdtemp(prefix='boba-fork-')
+        fn = os.path.join(self.folder, 'plan.json')
+        with open(fn, 'w') as f:
+            json.dump({'nodes': self.nodes, 'cwd': self.cwd,
+                       'jobs': self.jobs}, f)
+
+        r, w = os.pipe()
+        try:
+            self.proc = await asyncio.create_subprocess_exec(
+                python(), os.path.abspath(__file__), fn, str(w),
+                pass_fds=(w,), stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL, start_new_session=True)
+        finally:
+            os.close(w)
+
+        self.status = asyncio.StreamReader()
+        await asyncio.get_running_loop().connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(self.status),
+            os.fdopen(r, 'rb', 0))
+
+    def terminate(self):
+        """ Stop every process of the tree """
+        if self.returncode is None:
+            try:
+                os.killpg(self.proc.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _path(self, uid):
+        """ The files of the nodes from the root to the end of a universe """
+        path = ['u{}'.format(uid)]
+        i = self._ends[uid]
+        while i is not None:
+            path.append(str(i))
+            i = self.nodes[i]['parent']
+        return path[::-1]
+
+    def _read(self, name):
+        """ The output, errors and record of a node or the end of a universe """
+        res = []
+        for ext in ('out', 'err'):
+            try:
+                with open(os.path.join(self.folder, name + '.' + ext),
+                          'rb') as f:
+                    res.append(f.read())
+            except IOError:
+                res.append(b'')
+        with open(os.path.join(self.folder, name + '.json')) as f:
+            res.append(json.load(f))
+        return res
+
+    def collect(self, uid):
+        """
+        Put together what a universe wrote, along its path in the tree.
+        :return: (output, errors, exit code, seconds)
+        """
+        out, err, code, seconds = b'', b'', 0, 0
+        for name in self._path(uid):
+            o, e, rec = self._read(name)
+            out, err, seconds = out + o, err + e, seconds + rec['wall']
+            if rec['code'] is not None:
+                code = rec['code']
+                break
+        return out, err, code, seconds
+
+    async def results(self):
+        """ Generate (universe id, output, errors, exit code, seconds) """
+        while True:
+            line = await self.status.readline()
+            if not line:
+                break
+            uid = int(line.split()[1])
+            self.done.add(uid)
+            yield (uid,) + self.collect(uid)
+
+    def cpu_time(self):
+        """
+        The CPU time the tree took, and the time the finished universes would
+        have taken had each run all of its blocks on its own.
+        """
+        cpu = {}
+        for name in os.listdir(self.folder):
+            if name.endswith('.json') and name != 'plan.json':
+                with open(os.path.join(self.folder, name)) as f:
+                    cpu[name[:-5]] = json.load(f)['cpu']
+
+        alone = sum(cpu.get(n, 0) for uid in self.done
+                    for n in self._path(uid))
+        return sum(cpu.values()), alone
+
+    async def wait(self):
+        if self.proc is not None:
+            await self.proc.wait()
+
+    def close(self):
+        if self.folder is not None:
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self.folder = None
+
+
+class _Executor:
+    """ Run the tree, in the executor and the processes it forks """
+
+    def __init__(self, plan, folder, status):
+        self.nodes = plan['nodes']
+        self.folder = folder
+        self.status = status
+        self.filenames = set(n['filename'] for n in self.nodes)
+        self.ns = {'__name__': '__main__', '__builtins__': builtins}
+        self.flags = 0
+
+        # the children of this process, and whether each holds a token
+        self.children = {}
+
+        # a pipe holds a token for each job but the first, which is the
+        # executor itself. A child with a token runs alongside its parent.
+        self.tokens = os.pipe()
+        os.set_blocking(self.tokens[0], False)
+        os.write(self.tokens[1], b'x' * (plan['jobs'] - 1))
+
+    def acquire(self):
+        """ Take a token if there is one, without waiting """
+        try:
+            return len(os.read(self.tokens[0], 1)) > 0
+        except BlockingIOError:
+            return False
+
+    def release(self):
+        os.write(self.tokens[1], b'x')
+
+    def report(self, uids):
+        for uid in uids:
+            os.write(self.status, 'done {}\n'.format(uid).encode('utf-8'))
+
+    def subtree_ends(self, i):
+        res = []
+        stack = [i]
+        while len(stack):
+            node = self.nodes[stack.pop()]
+            res.extend(node['ends'])
+            stack.extend(node['children'])
+        return res
+
+    def _redirect(self, name):
+        """ Send the output and errors that follow to the files of a node """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, ext in ((1, 'out'), (2, 'err')):
+            f = os.open(os.path.join(self.folder, name + '.' + ext),
+                        os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.dup2(f, fd)
+            os.close(f)
+
+    def _record(self, name, code, t0, c0):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        with open(os.path.join(self.folder, name + '.json'), 'w') as f:
+            json.dump({'code': code, 'wall': time.perf_counter() - t0,
+                       'cpu': time.process_time() - c0}, f)
+
+    def run_node(self, i):
+        """ Run the code of a node, then branch into its children """
+        node = self.nodes[i]
+        t0, c0 = time.perf_counter(), time.process_time()
+        self._redirect(str(i))
+        self.ns['__file__'] = node['filename']
+        sys.argv[0] = os.path.basename(node['filename'])
+        code, exited = None, False
+        try:
+            co = compile('\n' * node['start'] + node['code'], node['filename'],
+                         'exec', self.flags, True)
+            self.flags |= co.co_flags & _FUTURE_FLAGS
+            exec(co, self.ns)
+        except SystemExit as e:
+            code, exited = exit_code(e), True
+        except BaseException as e:
+            print_error(e, self.filenames)
+            code = 1
+
+        # the universes below end here as well
+        if code is not None:
+            self._exit(exited)
+        self._record(str(i), code, t0, c0)
+        if code is not None:
+            self.report(self.subtree_ends(i))
+            return
+        self.branch(i)
+
+    def _exit(self, exited=False):
+        """
+        Shut down as the interpreter would after running a script, which
+        removes __file__ first, unless the script called sys.exit()
+        """
+        if not exited:
+            self.ns.pop('__file__', None)
+        if hasattr(threading, '_shutdown'):
+            threading._shutdown()
+        atexit._run_exitfuncs()
+
+    def finish(self, uid):
+        """ End a universe that ran to its end """
+        t0, c0 = time.perf_counter(), time.process_time()
+        name = 'u{}'.format(uid)
+        self._redirect(name)
+        self._exit()
+        self._record(name, None, t0, c0)
+        self.report([uid])
+
+    def branch(self, i):
+        """
+        Run each universe that ends here, and each child, in a process of its
+        own, except the last, which continues in this process. A child runs
+        alongside this process while there is a token for it. Otherwise this
+        process waits for the child and its subtree before going on, so that
+        each job keeps at most one process per level of the tree.
+        """
+        node = self.nodes[i]
+        tasks = [(self.finish, uid, 'u{}'.format(uid)) for uid in node['ends']]
+        tasks += [(self.run_node, c, str(c)) for c in node['children']]
+
+        for k, (fn, arg, name) in enumerate(tasks):
+            self.wait(block=False)
+            # the last one needs no copy of this process
+            if k == len(tasks) - 1:
+                fn(arg)
+                break
+            alongside = self.acquire()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self.children = {}
+                    fn(arg)
+                finally:
+                    os._exit(0)
+            self.children[pid] = (fn, arg, name, alongside)
+            if not alongside:
+                self.wait(pid)
+        self.wait()
+
+    def wait(self, pid=None, block=True):
+        """
+        Reap the children that have exited, or wait for a child, or for all
+        of them. The token of a child goes back when it is reaped.
+        """
+        pids = list(self.children) if pid is None else [pid]
+        for p in pids:
+            done, status = os.waitpid(p, 0 if block else os.WNOHANG)
+            if not done:
+                continue
+            fn, arg, name, alongside = self.children.pop(p)
+            if alongside:
+                self.release()
+
+            rec = os.path.join(self.folder, name + '.json')
+            if status != 0 and not os.path.exists(rec):
+                # it died while running
+                with open(rec, 'w') as f:
+                    json.dump({'code': wait_code(status), 'wall': 0, 'cpu': 0},
+                              f)
+                self.report([arg] if fn == self.finish else
+                            self.subtree_ends(arg))
+
+
+def execute(fn, status):
+    """ The main function of the executor """
+    with open(fn) as f:
+        plan = json.load(f)
+    os.chdir(plan['cwd'])
+    sys.path.insert(0, plan['cwd'])
+    sys.argv = ['']
+    ex = _Executor(plan, os.path.dirname(fn), status)
+    ex.run_node(0)
+
+
+if __name__ == '__main__':
+    # do not let the folder of this file shadow the modules of universes
+    sys.path.pop(0)
+    execute(sys.argv[1], int(sys.argv[2]))
@@ -11,6 +11,10 @@ class GraphAnalyzer:
         self.edges = GraphAnalyzer._convert_edges(edges)
         self.paths = []
 
+        # memoized path counts, keyed by the ending node, to prune branches
+        self._order = None
+        self._counts = {}
+
     @staticmethod
     def _convert_edges(edges):
         d = {}
@@ -38,32 +42,67 @@ class GraphAnalyzer:
         """ nodes that have no outgoing edges """
         return self.nodes.difference(set(self.edges.keys()))
 
-    def _all_paths_recur(self, a, b, visited, path):
-        """ a recursive func to get all paths from a to b"""
-        # mark the current node as visited and add to path
-        visited.add(a)
-        path.append(a)
-
-        # if current node is the same as target, the path is done
-        if a == b:
-            self.paths.append([nd for nd in path])
-        else:
-            if a in self.edges:
-                for n in self.edges[a]:
-                    if n not in visited:
-                        self._all_paths_recur(n, b, visited, path)
-
-        # remove current node from path and mark it as unvisited
-        path.pop()
-        visited.discard(a)
+    def _topological_order(self):
+        """ order the nodes so that every edge points forward """
+        indegree = {nd: 0 for nd in self.nodes}
+        for lst in self.edges.values():
+            for n in lst:
+                indegree[n] += 1
+
+        order = [nd for nd in self.nodes if indegree[nd] == 0]
+        i = 0
+        while i < len(order):
+            for n in self.edges.get(order[i], []):
+                indegree[n] -= 1
+                if indegree[n] == 0:
+                    order.append(n)
+            i += 1
+
+        if len(order) < len(self.nodes):
+            self._throw('The graph contains a cycle')
+        return order
+
+    def _count_to(self, t):
+        """ the number of paths from every node to t, memoized per target """
+        if t not in self._counts:
+            if self._order is None:
+                self._order = self._topological_order()
+
+            # a node reaches t through any of its children
+            counts = {}
+            for nd in reversed(self._order):
+                counts[nd] = 1 if nd == t else \
+                    sum(counts[n] for n in self.edges.get(nd, []))
+            self._counts[t] = counts
+        return self._counts[t]
 
     def _all_paths(self, s, t):
-        """ get all paths from s to t """
-        visited = set()
-        path = []
-        self._all_paths_recur(s, t, visited, path)
+        """ lazily yield all paths from s to t, skipping dead branches """
+        counts = self._count_to(t)
+        if counts[s] == 0:
+            return
+
+        def live(nd):
+            return (n for n in self.edges.get(nd, []) if counts[n])
+
+        path = [s]
+        stack = [live(s)]
+        if s == t:
+            yield [s]
+            return
+
+        while len(stack):
+            nd = next(stack[-1], None)
+            if nd is None:
+                stack.pop()
+                path.pop()
+            elif nd == t:
+                yield path + [nd]
+            else:
+                path.append(nd)
+                stack.append(live(nd))
 
-    def _construct_paths(self):
+    def _check_ends(self):
         ss = self._get_source()
         ts = self._get_target()
 
@@ -72,13 +111,33 @@ class GraphAnalyzer:
         if len(ts) == 0:
             self._throw('Cannot find any ending node')
 
+        return ss, ts
+
+    def count(self):
+        """
+        Count all paths from a starting node to an ending node, in time linear
+        in the size of the graph, without enumerating them.
+        """
+        if len(self.nodes) == 0:
+            return 0
+
+        ss, ts = self._check_ends()
+        return sum(self._count_to(t)[s] for s in ss for t in ts)
+
+    def iter_paths(self):
+        """
+        Lazily yield all paths from a starting node to an ending node. The
+        path counts are shared between sources, so no branch is explored
+        unless it leads to the current ending node.
+        """
+        if len(self.nodes) == 0:
+            return
+
+        ss, ts = self._check_ends()
         for s in ss:
             for t in ts:
-                self._all_paths(s, t)
+                yield from self._all_paths(s, t)
 
     def analyze(self):
-        if len(self.nodes) == 0:
-            return []
-
-        self._construct_paths()
+        self.paths = list(self.iter_paths())
         return self.paths
@@ -1,60 +1,103 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
-from copy import deepcopy
 
+import array
+import hashlib
 import json
 import os
+import multiprocessing as mp
 import pickle
+import time
+import tracemalloc
+import numpy as np
 from textwrap import wrap
-from dataclasses import dataclass, field
 from typing import List, Tuple, Dict, Tuple
 from tqdm import tqdm
 from src.gumtree.main.trees.tree import Tree
 
 from .baseparser import ParseError
 from .codeparser import CodeParser, Chunk, BlockCode
+from .codegen import CodeGenerator, History, DecRecord
 from .graphparser import GraphParser
 from .graphanalyzer import GraphAnalyzer, InvalidGraphError
 from .decisionparser import DecisionParser
 from .constraintparser import ConstraintParser
 from .lang import LangError, Lang
-from .wrangler import Wrangler, DIR_SCRIPT
+from .wrangler import Wrangler, DIR_SCRIPT, DIR_PARSER, FILE_MATRIX, \
+    FILE_INDEX, FILE_PROFILE, get_universe_script
 from .adg import ADG
+from .decisionmatrix import DecisionMatrixBuilder, RowIndex
+from .profiler import Profiler
 
 import src.boba.util as util
 
-@dataclass
-class History:
-    """
-    A class for keeping track of the choices made in each universe.
 
-    path: index of the code path.
-    filename: file name of the universe.
-    decisions: placeholder variables and the options they took.
-    skipped: nodes that are skipped.
+class _Records:
     """
-    path: int
-    filename: str = ''
-    decisions: List[DecRecord] = field(default_factory=lambda: [])
-    skipped: List = field(default_factory=lambda: [])
-
-    @property
-    def decision_dict(self) -> Dict[str, Tuple[str, int]]:
-        return {dec_record.parameter: (dec_record.option, dec_record.idx) for dec_record in self.decisions}
-        
+    What a compile keeps of each universe, instead of its history: its row of
+    the decision matrix, its row of the summary, and a digest of its decisions
+    for the manifest. Only the first few histories are kept, to print.
+    """
+
+    # the number of histories to print
+    FIRST = 10
+
+    def __init__(self, discrete, decs, summary):
+        """
+        :param discrete: the names of the discrete decisions.
+        :param decs: the names of all decisions, in the order of the summary.
+        :param summary: the DecisionMatrixBuilder of the summary.
+        """
+        self.decs = decs
+        self.size = 0
+        self.first = []
+        self.columns = {d: j + 1 for j, d in enumerate(discrete)}
+        self.rows = array.array('i')
+        self.summary = summary
+        self.digests = []
+
+    def add(self, history, decisions, digest, outputs=()):
+        """
+        Record a universe, and its row in the summary: the decisions, whose
+        digest is given, followed by any outputs.
+        """
+        self.size += 1
+        if len(self.first) < _Records.FIRST:
+            self.first.append(history)
+
+        row = [-1] * (len(self.columns) + 1)
+        row[0] = history.path
+        for d in history.decisions:
+            row[self.columns[d.parameter]] = d.idx
+        self.rows.extend(row)
+
+        self.summary.add(decisions + list(outputs))
+        self.digests.append(digest)
+
+    @staticmethod
+    def digest(decisions):
+        """ The digest of the decisions of a universe, for the manifest """
+        return hashlib.sha1(json.dumps(decisions).encode('utf-8')).hexdigest()
+
+    def row(self, uid):
+        """ The row of a universe in the decision matrix """
+        width = len(self.columns) + 1
+        return self.rows[(uid - 1) * width:uid * width]
+
+    def matrix(self):
+        """
+        The decision matrix, one row per universe: the code path, followed by
+        the option index of each discrete decision, or -1 if not made.
+        """
+        return np.frombuffer(self.rows, dtype=np.intc)\
+            .reshape(self.size, len(self.columns) + 1).astype(np.int32)
 
-@dataclass
-class DecRecord:
-    """ A class for what options a parameter took. """
-    parameter: str = ''
-    option: str = ''
-    idx: int = -1
 
 class Parser:
 
     """ Parse everything """
 
-    def __init__(self, f1, out='.', lang=None, add_paren=False):
+    def __init__(self, f1, out='.', lang=None, add_paren=False, profile=False):
         self.fn_script = os.path.abspath(f1)
         with open(self.fn_script, 'r') as f:
             self.template_code = f.read()
@@ -62,20 +105,38 @@ class Parser:
         self.out = os.path.join(out, 'multiverse/')
 
         self.paths = []
-        self.history = []
+        self.path_count = 0
         self.constraints = {}
 
+        # what a compile keeps of the universes it generates
+        self._records = None
+
+        # whether the scripts are left out or packed into one file, and the
+        # decision matrix of a multiverse loaded from disk
+        self.virtual = False
+        self.packed = False
+        self.matrix = None
+        self._generator = None
+        self._index = None
+        self._path_info = None
+        self._path_lookup = None
+
         # init parser class
         self.code_parser = CodeParser()
         self.dec_parser = DecisionParser()
         self.adg = ADG()
+        self.profiler = Profiler(profile)
 
         # parse
-        self._parse_blocks()
+        with self.profiler.phase('parse_blocks'):
+            self._parse_blocks()
         self.spec = self.code_parser.spec
-        self._parse_decs()
-        self._parse_graph()
-        self._parse_constraints()
+        with self.profiler.phase('parse_decisions'):
+            self._parse_decs()
+        with self.profiler.phase('parse_graph'):
+            self._parse_graph()
+        with self.profiler.phase('parse_constraints'):
+            self._parse_constraints()
 
        
 
@@ -91,6 +152,8 @@ class Parser:
 
             self.lang = Lang(f1, lang=lang, supported_langs=supported_langs)
             self.wrangler = Wrangler(self.spec, self.lang, self.out)
+            self.wrangler.col = 2 + len(self.dec_parser.get_decs())\
+                + len(self.code_parser.get_decisions())
           
         except LangError as e:
             self._throw(e.args[0])
@@ -186,15 +249,16 @@ class Parser:
             # expand the graph with options
             nodes, edges = gp.replace_graph(self.code_parser.get_decisions())
 
-            # analyze the graph to get paths
-            self.paths = GraphAnalyzer(nodes, edges).analyze()
-    
-            # an ugly way to handle the artificial _start node
-            if '_start' in self.code_parser.blocks and '_start' not in nodes:
-                for p in self.paths:
-                    p.insert(0, '_start')
-                if len(self.paths) == 0:
-                    self.paths = [['_start']]
+            # analyze the graph to get paths, and an ugly way to handle the
+            # artificial _start node
+            ga = GraphAnalyzer(nodes, edges)
+            self.path_count = ga.count()
+            start = ['_start'] if '_start' in self.code_parser.blocks \
+                and '_start' not in nodes else []
+            self.paths = [start + p for p in ga.iter_paths()]
+            if len(self.paths) == 0 and len(start):
+                self.paths = [start]
+                self.path_count = 1
 
             # save data to adg
             self.adg.set_graph(nodes, edges)
@@ -213,224 +277,305 @@ class Parser:
         except ParseError as e:
             self._throw_spec_error(e.args[0])
 
-    def _eval_constraint(self, history, con):
-        """ See if the constraint holds true given the choices made. """
-        con = self.constraints[con].condition
-        paths, bdecs = self._nice_path(self._get_skipped_path(history))
-
-        # A dict where the key is each parameter and the value is the chosen
-        # option. For ordinary blocks, key and value are the same.
-        res = {}
-        for p in paths:
-            res[p] = p
-        for d in bdecs:
-            # note that block parameter will override with the actual option
-            res[d.parameter] = d.option
-        for d in self.dec_parser.get_decs():
-            # unmade decisions will have value None and index -1
-            res[d] = None
-            res[ConstraintParser.make_index_var(d)] = -1
-        for d in history.decisions:
-            res[d.parameter] = d.option
-            res[ConstraintParser.make_index_var(d.parameter)] = d.idx
-
-        # now evaluate
-        return eval(con, res)
-
     def _get_code_paths(self):
-        """ Convert paths of block to paths of code chunk """
-
-        res = []
-
+        """ Lazily convert paths of block to paths of code chunk """
         for path in self.paths:
             pt = []
             for nd in path:
                 # replace the node by its chunks
                 chunks = [(nd, ch) for ch in self.code_parser.blocks[nd].chunks]
                 pt.extend(chunks)
-            res.append(pt)
+            yield pt
 
-        return res
-    # @profile
-    def _code_gen_recur(self, 
-                        path: List[Tuple[str, Chunk]], 
-                        path_block_changes: List[Tuple[str, int, int]], 
-                        p_i: int, 
-                        pbc_i: int, 
-                        code: str, 
-                        cur_block_code: str, 
-                        history: History,
-                        block_codes: List[BlockCode]):
+    def _get_generator(self) -> CodeGenerator:
+        return CodeGenerator(self._get_code_paths(), self.dec_parser,
+                             self.constraints, add_paren=self.add_paren)
+
+    def _render(self, uid, history, code):
+        """ Fill in the reserved keywords and append the output code. """
+        code = self.wrangler.render_universe(uid, code)
+
+        # the output code goes into the last block
+        history.blocks[-1].code_length += \
+            code.count('\n') - sum(b.code_length for b in history.blocks) + 1
+        return code
+
+    def iter_universes(self):
         """
-        Generate code recursively.
+        Lazily enumerate all universes, in the order they are numbered.
 
-        :param path: the code path we're on.
-        :param i: the index of the current node in the code path.
-        :param code: the generated code so far.
-        :param history: record the choices made.
+        :return: a generator of (uid, history, code), where history records
+            the choices made and the block layout of the universe, and code is
+            the complete universe script.
         """
+        generator = self._get_generator()
 
-        if p_i >= len(path): #base case
-            # write file
-            
-            fn, code, cur_block_code = self.wrangler.write_universe(code, cur_block_code)
-
-            # record history
-            history.filename = fn
-            self.history.append(history)
-            block_codes  = block_codes + [BlockCode(dec_name=path_block_changes[pbc_i][0].split(':')[0],
-                                         opt_name=path_block_changes[pbc_i][0].split(':')[-1],
-                                         code_length=cur_block_code.count('\n') + 1
-                                        )]
-            # block_codes[0].code_length += 1
-            assert sum(b.code_length for b in block_codes) == len(code.split('\n'))
-            self.blocks_code.append(block_codes)
-        else:
-            if p_i == path_block_changes[pbc_i][2]:
-                block_codes = block_codes + [BlockCode(
-                    dec_name=path_block_changes[pbc_i][0].split(':')[0],
-                    opt_name=path_block_changes[pbc_i][0].split(':')[-1],
-                    code_length=cur_block_code.count('\n')
-                )]
-                pbc_i += 1
-                cur_block_code = ''
-            
-            nd, chunk = path[p_i]
-
-            # check if the block has constraints attached to it
-            names = [nd, nd.split(':')[0]]
-            for n in names:
-                if n in self.constraints and\
-                        not self._eval_constraint(history, n):
-                    # constraint met
-                    if self.constraints[n].skip:
-                        # skip the node and continue
-                        history.skipped.append(nd)
-                        self._code_gen_recur(path, 
-                                             path_block_changes,
-                                             p_i + 1, 
-                                             pbc_i,
-                                             code, 
-                                             cur_block_code, 
-                                             history,
-                                             block_codes)
-                        return
-                    else:
-                        # abort codegen
-                        return
-
-            if chunk.variable != '':
-                # check if we have already encountered the placeholder variable
-                prev_idx = None
-                for d in history.decisions:
-                    if d.parameter == chunk.variable:
-                        prev_idx = d.idx
-
-                if prev_idx is not None:
-                    # use the previous value
-                    # if chunk.variable.startswith('_'):
-                    #     snippet = chunk.code + '{{' + chunk.variable + '}}'
-                    #     self._code_gen_recur(path, 
-                    #                      path_block_changes,
-                    #                      p_i + 1, 
-                    #                      pbc_i,
-                    #                      code + snippet, 
-                    #                      cur_block_code + snippet, 
-                    #                      history,
-                    #                      block_codes)
-                    snippet, opt = self.dec_parser.gen_code(chunk.code, chunk.variable, prev_idx, add_paren=self.add_paren)
-                    self._code_gen_recur(path, 
-                                         path_block_changes,
-                                         p_i + 1, 
-                                         pbc_i,
-                                         code + snippet, 
-                                         cur_block_code + snippet, 
-                                         history,
-                                         block_codes)
-                else:
-                    # expand the decision
-                    if chunk.variable.startswith('_'):
-                        snippet = chunk.code + '{{' + chunk.variable + '}}'
-                        # decs = [a for a in history.decisions]
-                        # decs.append(DecRecord(chunk.variable, -1, -1))
-                        self._code_gen_recur(path,
-                                             path_block_changes,
-                                             p_i + 1,
-                                             pbc_i,
-                                             code + snippet,
-                                             cur_block_code + snippet,
-                                             history,
-                                             deepcopy(block_codes)
-                                             )
-                    else:
-                        num_alt = self.dec_parser.get_num_alt_discrete(chunk.variable)
-                        for k in range(num_alt):
-                            # check if the option has constraints attached to it
-                            # always check by index, rather than actual value
-                            v = ConstraintParser.make_index_var(chunk.variable)
-                            v = '{}:{}'.format(v, k)
-                            if v in self.constraints and \
-                                    not self._eval_constraint(history, v):
-                                # constraint met, abort
-                                continue
-
-                            # code gen
-                            snippet, opt = self.dec_parser.gen_code(chunk.code, chunk.variable, k, add_paren=self.add_paren)
-                            decs = [a for a in history.decisions]
-                            decs.append(DecRecord(chunk.variable, opt, k))
-                            self._code_gen_recur(path, 
-                                                path_block_changes, 
-                                                p_i + 1, 
-                                                pbc_i,
-                                                code + snippet, 
-                                                cur_block_code + snippet,
-                                                History(history.path, '', decs),
-                                                deepcopy(block_codes))
+        uid = 0
+        for idx in range(len(generator.paths)):
+            for history, code in generator.iter_path(idx):
+                uid += 1
+                yield uid, history, self._render(uid, history, code)
+
+    def get_universe(self, uid):
+        """
+        Render a universe on demand, from the recorded choices.
+
+        :param uid: the universe id.
+        :return: (history, code), where history includes the block layout.
+        """
+        if self._generator is None:
+            self._generator = self._get_generator()
+
+        row = self.matrix[uid - 1] if self.matrix is not None else \
+            self._records.row(uid)
+        idx = int(row[0])
+        fixed = {d: int(k) for d, k in
+                 zip(self.dec_parser.discrete_decisions, row[1:]) if k >= 0}
+
+        history, code = next(self._generator.iter_path(idx, fixed=fixed))
+        history.filename = get_universe_script(uid, self.lang.get_ext())
+        return history, self._render(uid, history, code)
+
+    def _get_radices(self):
+        """ The number of values in each column of the decision matrix """
+        return [self.path_count] + [len(d.value) for d in
+                                    self.dec_parser.discrete_decisions.values()]
+
+    def _get_index(self):
+        """ Load, or build, the index from a matrix row to the universe id """
+        if self._index is None:
+            fn = os.path.join(self.out, DIR_SCRIPT, DIR_PARSER, FILE_INDEX)
+            if self.matrix is not None and os.path.exists(fn):
+                self._index = RowIndex.load(fn)
             else:
-                code += chunk.code
-                cur_block_code += chunk.code
-                self._code_gen_recur(path, path_block_changes, p_i+1, pbc_i, code, cur_block_code,
-                                     history, block_codes)
-
-    def _code_gen(self):
-        paths = self._get_code_paths()
-        def get_path_block_changes(paths) -> List[Tuple[str, int, int]]:  
-            paths_block_change_idxs = []
-            for path in paths:
-                path_block_changes = []
-                cur_block_name = path[0][0]
-                cur_block_start = 0
-                cur_var = path[0][1].variable
-                for ind, path_step in enumerate(path[1:]):
-                    if path_step[0] == cur_block_name and not (cur_var == ''):
-                        continue
-                    else:
-                        path_block_changes.append((cur_block_name, cur_block_start, ind+1))
-                        cur_block_name = path_step[0]
-                        cur_block_start = ind + 1
-                    cur_var = path_step[1].variable
-                path_block_changes.append((cur_block_name, cur_block_start, len(path)))
-                paths_block_change_idxs.append(path_block_changes)
-            return paths_block_change_idxs
-        path_block_changes = get_path_block_changes(paths)   
-
-        self.wrangler.counter = 0  # keep track of file name
-        self.history = []          # keep track of choices made for each file
-        self.blocks_code = []
-        self.wrangler.col = 2 + len(self.dec_parser.get_decs())\
-            + len(self.code_parser.get_decisions())
-
-        self.wrangler.create_dir()
+                self._index = RowIndex.build(self._get_rows(),
+                                             self._get_radices())
+        return self._index
+
+    def _get_rows(self):
+        return self.matrix if self.matrix is not None else \
+            self._records.matrix()
+
+    def _match_paths(self, given):
+        """
+        The code paths that agree with the given block decisions, and contain
+        the given code path, which may leave out skipped blocks.
+        """
+        if self._path_info is None:
+            self._path_info = []
+            for path in self.paths:
+                nice, bdecs = self._nice_path(path)
+                self._path_info.append(
+                    (nice, {d.parameter: d.option for d in bdecs}))
+
+        for idx, (nice, bdecs) in enumerate(self._path_info):
+            if any(bdecs.get(k) != v for k, v in given.items()
+                   if k != 'Code Path'):
+                continue
+            if 'Code Path' in given:
+                it = iter(nice)
+                if not all(nd in it for nd in given['Code Path'].split('->')):
+                    continue
+            yield idx
+
+    def lookup(self, decisions):
+        """
+        Find the universe that makes the given decisions, without enumerating
+        the multiverse. The given block decisions are checked against every
+        code path, and each matching path takes one probe of the index, so the
+        time does not grow with the number of universes.
+
+        :param decisions: a dict from decision to option. Placeholder variables
+            that are left out are not made. Block decisions and the code path
+            can be left out, as long as only one universe matches.
+        :return: the universe id, or None if no universe matches.
+        """
+        discrete = list(self.dec_parser.discrete_decisions)
+        blocks = self.code_parser.get_decisions()
+        row = [-1] * (len(discrete) + 1)
+        given = {}
+        for name, opt in decisions.items():
+            if name in blocks or name == 'Code Path':
+                given[name] = str(opt)
+                continue
+            if name not in self.dec_parser.discrete_decisions:
+                raise KeyError('Unknown decision "{}"'.format(name))
+            opts = [str(v) for v in
+                    self.dec_parser.discrete_decisions[name].value]
+            if str(opt) not in opts:
+                return None
+            row[discrete.index(name) + 1] = opts.index(str(opt))
+
+        index = self._get_index()
+        found = set()
+        for idx in self._match_paths(given):
+            row[0] = idx
+            uid = index.find(row)
+            if uid is not None:
+                found.add(uid)
+        if len(found) > 1:
+            raise ValueError('The decisions match {} universes'
+                             .format(len(found)))
+        return found.pop() if len(found) else None
+
+    def neighbors(self, uid, decision):
+        """
+        Find the universes that differ from a universe only in one decision.
+
+        :param uid: the universe id.
+        :param decision: a placeholder variable or a block decision.
+        :return: a dict from each other option to the universe that takes it,
+            for the options where such a universe exists.
+        """
+        row = [int(c) for c in self._get_rows()[uid - 1]]
+        index = self._get_index()
+        blocks = self.code_parser.get_decisions()
+        res = {}
+        if decision in self.dec_parser.discrete_decisions:
+            j = list(self.dec_parser.discrete_decisions).index(decision) + 1
+            opts = self.dec_parser.discrete_decisions[decision].value
+            for k, opt in enumerate(opts):
+                if k != row[j]:
+                    nb = row[:j] + [k] + row[j + 1:]
+                    found = index.find(nb)
+                    if found is not None:
+                        res[str(opt)] = found
+        elif decision in blocks:
+            # swap the block option in the code path
+            if self._path_lookup is None:
+                self._path_lookup = {tuple(p): i
+                                     for i, p in enumerate(self.paths)}
+            path = self.paths[row[0]]
+            cur = [nd for nd in path if nd in blocks[decision]]
+            for bl in blocks[decision] if len(cur) else []:
+                other = tuple(bl if nd == cur[0] else nd for nd in path)
+                if bl != cur[0] and other in self._path_lookup:
+                    found = index.find([self._path_lookup[other]] + row[1:])
+                    if found is not None:
+                        res[bl.split(':')[1]] = found
+        else:
+            raise KeyError('Unknown decision "{}"'.format(decision))
+        return res
+
+    def _get_tasks(self, generator):
+        """ Split the multiverse by code path and the first decision. """
+        return [(idx, k) for idx in range(len(generator.paths))
+                for k in range(generator.get_max_branches(idx))]
+
+    def _code_gen(self, jobs=1, virtual=False, incremental=False, pack=False):
+        self.virtual = virtual
+        self.packed = pack and not virtual
+
+        self.wrangler.create_dir(incremental)
+        if self.packed:
+            self.wrangler.open_pack()
+        else:
+            self.wrangler.remove_pack()
+
+        # the summary is written as the universes are generated
+        names = self._get_summary_names()
+        self._records = _Records(self.dec_parser.discrete_decisions,
+                                 self._get_decs(),
+                                 self._get_summary_builder(names))
+        self.wrangler.open_summary(['Filename'] + names)
         with tqdm() as pbar:
-            self.wrangler.pbar = pbar
-            for idx, (p, pbc) in enumerate(zip(paths, path_block_changes)):
-                self._code_gen_recur(p, pbc, 0, 0, '', '', History(idx), [])
-        self.wrangler.pbar = None
+            if virtual:
+                self._code_gen_virtual(pbar)
+            elif jobs == 1:
+                self.wrangler.pbar = pbar
+                for uid, history, code in self.iter_universes():
+                    history.filename = self.wrangler.write_universe(uid, code)
+                    self._record(history)
+                self.wrangler.pbar = None
+            else:
+                self._code_gen_parallel(jobs, pbar)
+        self.wrangler.close_summary()
+        if self.packed:
+            self.wrangler.close_pack()
+
+        # record what was generated, and clean up after the previous compile
+        n = self._records.size
+        hashes = [] if virtual else \
+            [self.wrangler.hashes[uid] for uid in range(1, n + 1)]
+        prev = self.wrangler.manifest
+        kept = self.wrangler.write_manifest(hashes, self._records.digests)
+        self.wrangler.remove_stale_universes(0 if virtual or self.packed
+                                             else n)
+        aliases = self._get_aliases(hashes)
+        self.wrangler.write_aliases(aliases)
+        if len(aliases):
+            print('{} universes are identical to another universe and will '
+                  'only run once.'.format(len(aliases)))
+        if prev is not None:
+            old = prev['hashes']
+            changed = sum(1 for i, h in enumerate(hashes)
+                          if i >= len(old) or old[i] != h)
+            print('Rewrote {} of {} universes, {} are unchanged and keep '
+                  'their results.'
+                  .format(changed, n, len(kept)))
+
         # write the pre and post execs to a file.
         self.wrangler.write_pre_exe()
         self.wrangler.write_post_exe()
         self.wrangler.write_lang()
 
+    @staticmethod
+    def _get_aliases(hashes):
+        """ Map each universe to the first universe with identical code. """
+        aliases = {}
+        first = {}
+        for uid, digest in enumerate(hashes, 1):
+            if digest in first:
+                aliases[uid] = first[digest]
+            else:
+                first[digest] = uid
+        return aliases
+
+    def _code_gen_virtual(self, pbar):
+        """
+        Enumerate the universes without assembling or writing their code. The
+        block layout is left out, and is recovered when a universe is rendered.
+        """
+        generator = self._get_generator()
+        ext = self.lang.get_ext()
+        uid = 0
+        for idx in range(len(generator.paths)):
+            for history, _ in generator.iter_path(idx, render=False):
+                uid += 1
+                history.filename = get_universe_script(uid, ext)
+                history.blocks = []
+                self._record(history)
+                pbar.update(1)
+
+    def _code_gen_parallel(self, jobs, pbar):
+        """
+        Generate and write the universes in a process pool. The universe ids
+        are assigned from an exact count of the universes in each task, so the
+        output is identical to the serial one.
+        """
+        generator = self._get_generator()
+        tasks = self._get_tasks(generator)
+        counts = [generator.count_path(idx, first) for idx, first in tasks]
+        with mp.Pool(jobs if jobs > 0 else mp.cpu_count(),
+                     initializer=_init_worker, initargs=(self,)) as pool:
+            offsets = []
+            uid = 0
+            for n in counts:
+                offsets.append(uid)
+                uid += n
+
+            args = [(t, o) for t, o, n in zip(tasks, offsets, counts) if n]
+            for histories, hashes, codes in pool.imap(_gen_task, args):
+                # a worker either wrote its universes, or left the code to be
+                # appended to the pack here
+                for h, digest in zip(histories, hashes):
+                    self.wrangler.hashes[self._records.size + 1] = digest
+                    self._record(h)
+                for h, code in zip(histories, codes):
+                    self.wrangler.write_universe(self._records.size + 1, code)
+                    self._record(h)
+                pbar.update(len(histories))
+
     @staticmethod
     def _nice_path(path):
         """ Convert the path containing block options back to the simpler path
@@ -444,25 +589,61 @@ class Parser:
         sk = set(h.skipped)
         return [nd for nd in self.paths[h.path] if nd not in sk]
 
+    def _get_decs(self):
+        """ The placeholder variables and block decisions """
+        return self.dec_parser.get_decs() + \
+            list(self.code_parser.get_decisions())
+
+    def _get_decision_row(self, h, decs):
+        """ The code path and the option of every decision in a universe """
+        paths, bdecs = self._nice_path(self._get_skipped_path(h))
+        row = ['->'.join(paths)]
+        mp = {}
+        for d in h.decisions:
+            mp[d.parameter] = d.option
+        for d in bdecs:
+            mp[d.parameter] = d.option
+        for d in decs:
+            value = mp[d] if d in mp else ''
+            row.append(value)
+        return row
+
+    def _get_summary_names(self):
+        """ The columns of the summary, after the file name """
+        return ['Code Path'] + self._get_decs() + self.wrangler.get_outputs()
+
+    def _get_summary_builder(self, names):
+        """
+        The builder of the decision matrix of the summary: the code path, every
+        decision and every output, per universe. The codes of a decision follow
+        the order its options are declared in.
+        """
+        blocks = self.code_parser.get_decisions()
+        options = {d: self.dec_parser.discrete_decisions[d].value
+                   for d in self.dec_parser.discrete_decisions}
+        options.update({b: [v.split(':')[1] for v in blocks[b]]
+                        for b in blocks})
+        return DecisionMatrixBuilder(names, options)
+
+    def _record(self, history):
+        """
+        Record a universe, and write its row of the summary CSV file. Its
+        script must be written first, as a universe that is kept also keeps
+        the outputs it recorded.
+        """
+        row = self._get_decision_row(history, self._records.decs)
+        digest = _Records.digest(row)
+        outputs = self.wrangler.read_kept_outputs(self._records.size + 1,
+                                                  digest)
+        self._records.add(history, row, digest, outputs)
+        self.wrangler.write_summary_row([history.filename] + row + outputs)
+
     def _write_csv(self):
-        rows = []
-        decs = self.dec_parser.get_decs() +\
-            [b for b in self.code_parser.get_decisions()]
-        ops = self.wrangler.get_outputs()
-        rows.append(['Filename', 'Code Path'] + decs + ops)
-        for h in self.history:
-            paths, bdecs = self._nice_path(self._get_skipped_path(h))
-            row = [h.filename, '->'.join(paths)]
-            mp = {}
-            for d in h.decisions:
-                mp[d.parameter] = d.option
-            for d in bdecs:
-                mp[d.parameter] = d.option
-            for d in decs:
-                value = mp[d] if d in mp else ''
-                row.append(value)
-            rows.append(row)
-        self.wrangler.write_summary(rows)
+        """
+        Write the decision matrix of the summary. The rows of the CSV file are
+        already written as the universes were generated.
+        """
+        self.wrangler.write_decision_matrix(self._records.summary.build())
 
     def _write_server_config(self):
         self.adg.create(self.code_parser.blocks)
@@ -486,12 +667,12 @@ class Parser:
 
     def _print_summary(self):
         w = 80
-        max_rows = 10
+        max_rows = _Records.FIRST
 
         print('=' * w)
         print('{:<20}{:<30}{:<30}'.format('Filename', 'Code Path', 'Decisions'))
         print('=' * w)
-        for idx, h in enumerate(self.history):
+        for idx, h in enumerate(self._records.first):
             paths, bdecs = self._nice_path(self._get_skipped_path(h))
             path = wrap('->'.join(paths), width=27)
             decs = ['{}={}'.format(d.parameter, d.option) for d in bdecs + h.decisions]
@@ -509,38 +690,127 @@ class Parser:
             print('-' * w)
 
             if idx >= max_rows - 1:
-                print('... {} more rows'.format(len(self.history) - max_rows))
+                print('... {} more rows'.format(self._records.size - max_rows))
                 break
 
+    def count(self):
+        """ Count the universes exactly, without generating any code. """
+        generator = self._get_generator()
+        return sum(generator.count_path(idx)
+                   for idx in range(len(generator.paths)))
+
     def _warn_size(self):
-        cap = self.dec_parser.get_cross_prod_discrete() * len(self.paths)
+        cap = self.count()
         if cap > 1024:
-            rs = input('\nBoba may create as many as {} scripts. '
+            rs = input('\nBoba will create {} scripts. '
                        'Proceed (y/n)?\n'.format(cap))
             if not rs.strip().lower().startswith('y'):
                 print('Aborted.')
                 exit(0)
     
     def _save_parser(self):
-        out_folder = os.path.join(self.out, DIR_SCRIPT, ".boba_parser")
-        os.makedirs(out_folder)
+        """
+        Save what it takes to render any universe later. The choices made in
+        each universe go into the decision matrix, which is memory-mapped when
+        loading, and the pickled parser leaves out everything that grows with
+        the number of universes.
+        """
+        out_folder = os.path.join(self.wrangler.out, DIR_SCRIPT, DIR_PARSER)
+        os.makedirs(out_folder, exist_ok=True)
+        matrix = self._records.matrix()
+        self.wrangler.write_matrix(matrix)
+        self.wrangler.write_index(RowIndex.build(matrix, self._get_radices()))
+
+        self._generator = self._index = None
+        self._path_info = self._path_lookup = None
+        # the parser is loaded from where the outputs end up, not where they
+        # are built
+        wr = self.wrangler
+        state = self._records, wr.hashes, wr.manifest, wr.out
+        self._records, wr.hashes, wr.manifest, wr.out = None, {}, None, wr.dest
         out_file = os.path.join(out_folder, 'parser.pickle')
         with open(out_file, 'wb') as f:
             pickle.dump(self, f)
+        self._records, wr.hashes, wr.manifest, wr.out = state
+
+    def _write_profile(self, jobs):
+        """ Write the time and memory of each phase to the output folder """
+        self.profiler.write(os.path.join(self.wrangler.out, FILE_PROFILE),
+                            template=self.fn_script, jobs=jobs,
+                            universes=self._records.size,
+                            time=time.strftime('%Y-%m-%dT%H:%M:%S'))
 
-    def main(self, verbose=True):
+    def main(self, verbose=True, jobs=1, virtual=False, incremental=False,
+             pack=False):
         self._warn_size()
-        self._code_gen()
-        self._write_csv()
-        self._write_server_config()
+        self.main_wo_warning(verbose, jobs, virtual, incremental, pack)
+
+    def main_wo_warning(self, verbose=True, jobs=1, virtual=False,
+                        incremental=False, pack=False):
+        with self.profiler.phase('code_gen'):
+            self._code_gen(jobs, virtual, incremental, pack)
+        with self.profiler.phase('write_csv'):
+            self._write_csv()
+        with self.profiler.phase('write_server_config'):
+            self._write_server_config()
         if verbose:
             self._print_summary()
-        self._save_parser()
+        with self.profiler.phase('save_parser'):
+            self._save_parser()
+        if self.profiler.enabled:
+            self._write_profile(jobs)
+        self.wrangler.swap_dir()
 
-    def main_wo_warning(self, verbose=True):
-        self._code_gen()
-        self._write_csv()
-        self._write_server_config()
-        if verbose:
-            self._print_summary()
-        self._save_parser()
\ No newline at end of file
+
+def load_parser(folder):
+    """
+    Load the parser saved when compiling a multiverse.
+
+    :param folder: the multiverse folder.
+    :return: the parser, or None if it does not exist.
+    """
+    out_folder = os.path.join(folder, DIR_SCRIPT, DIR_PARSER)
+    fn = os.path.join(out_folder, 'parser.pickle')
+    if not os.path.exists(fn):
+        return None
+    with open(fn, 'rb') as f:
+        ps = pickle.load(f)
+    ps.matrix = np.load(os.path.join(out_folder, FILE_MATRIX), mmap_mode='r')
+    return ps
+
+
+# these functions can't be in the class because multiprocess
+# does not know how to properly serialize functions in classes
+# the parser and code generator of a worker in a parallel compile
+_worker = {}
+
+
+def _init_worker(parser):
+    # a worker forked while profiling need not trace its own memory
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _worker['parser'] = parser
+    _worker['generator'] = parser._get_generator()
+
+
+def _gen_task(args):
+    """
+    Generate the universes in a task. Write them, unless they go into a pack,
+    which only the parent process appends to.
+    """
+    (idx, first), uid = args
+    ps = _worker['parser']
+    histories = []
+    hashes = []
+    codes = []
+    for history, code in _worker['generator'].iter_path(idx, first=first):
+        uid += 1
+        code = ps._render(uid, history, code)
+        if ps.packed:
+            history.filename = get_universe_script(uid, ps.lang.get_ext())
+            codes.append(code)
+        else:
+            history.filename = ps.wrangler.write_universe(uid, code)
+            hashes.append(ps.wrangler.hashes.pop(uid))
+        histories.append(history)
+    return histories, hashes, codes
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class Profiler:
+    """
+    Record the wall time, CPU time and peak memory of each phase of a compile.
+    CPU time counts this process and, separately, the worker processes that
+    finished during the phase. Memory is traced with tracemalloc, only while a
+    phase runs, and counts what the phase allocates in this process.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        """ Profile the code in a with-statement as a phase """
+        if not self.enabled:
+            yield
+            return
+
+        tracemalloc.start()
+        t0, c0, w0 = time.perf_counter(), time.process_time(), os.times()
+        try:
+            yield
+        finally:
+            t1, c1, w1 = time.perf_counter(), time.process_time(), os.times()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.phases.append({
+                'phase': name,
+                'wall': round(t1 - t0, 6),
+                'cpu': round(c1 - c0, 6),
+                'cpu_children': round(w1.children_user + w1.children_system
+                                      - w0.children_user - w0.children_system,
+                                      6),
+                'peak_memory': peak
+            })
+
+    def total(self):
+        res = {k: sum(p[k] for p in self.phases)
+               for k in ('wall', 'cpu', 'cpu_children')}
+        res['peak_memory'] = max([p['peak_memory'] for p in self.phases],
+                                 default=0)
+        return res
+
+    def write(self, fn, **info):
+        """ Write the phases, the totals and any extra info as JSON """
+        res = dict(info)
+        res['phases'] = self.phases
+        res['total'] = self.total()
+        with open(fn, 'w') as f:
+            json.dump(res, f, indent=2)
+
+    def format(self):
+        """ A table of the phases, for printing """
+        rows = ['{:<24}{:>10}{:>10}{:>12}{:>14}'.format(
+            'Phase', 'Wall (s)', 'CPU (s)', 'Workers (s)', 'Peak (MB)')]
+        for p in self.phases + [dict(self.total(), phase='total')]:
+            rows.append('{:<24}{:>10.3f}{:>10.3f}{:>12.3f}{:>14.1f}'.format(
+                p['phase'], p['wall'], p['cpu'], p['cpu_children'],
+                p['peak_memory'] / 2 ** 20))
+        return '\n'.join(rows)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Run R universes in persistent R processes. A worker runs rworker.R, which
+loads a list of packages once and then sources each universe into a fresh
+environment, so that the universes share the cost of starting R and loading
+packages. The output and messages of a universe come back through two named
+pipes, and its status through the standard output of the worker.
+
+A universe that may call quit() runs with Rscript instead, and a worker that
+exits in the middle of a universe is replaced, after the universe runs again
+with Rscript.
+"""
+
+import asyncio
+import os
+import re
+import shutil
+import signal
+import tempfile
+
+from .warmstart import WorkerLost
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'rworker.R')
+
+# the prefix of a status line of the worker
+_STATUS = b'\x01boba '
+
+# a call to quit() or q(), which would end the worker
+_QUIT = re.compile(r'(?<![\w.])(?:base::)?(?:quit|q)\s*\(')
+
+
+def available():
+    """ Whether R and named pipes are available """
+    return hasattr(os, 'mkfifo') and shutil.which('Rscript') is not None
+
+
+def calls_quit(code):
+    """ Whether R code may call quit() """
+    return _QUIT.search(code) is not None
+
+
+class RChild:
+    """ A universe running in an R worker """
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.returncode = None
+
+    def terminate(self):
+        """ Stop the universe, which takes down the worker with it """
+        if self.returncode is None:
+            self.returncode = -signal.SIGTERM
+            if self.worker.proc is not None:
+                self.worker.proc.terminate()
+
+
+class RWorker:
+    """
+    The supervisor side of an R worker, to use from an event loop. The worker
+    starts with the first universe, and again after it is lost or a universe
+    leaves it in a state it cannot undo.
+    """
+
+    def __init__(self, packages):
+        self.packages = list(packages)
+        self.proc = None
+        self.folder = None
+
+    @staticmethod
+    def can_run(cmds, script, cwd):
+        """ Whether a universe only runs with Rscript, and never quits R """
+        if cmds != [['Rscript', script]]:
+            return False
+        with open(os.path.join(cwd, script)) as f:
+            return not calls_quit(f.read())
+
+    async def start(self):
+        self.folder = tempfile.mkdtemp(prefix='boba-r-')
+        for name in ('out', 'err'):
+            os.mkfifo(os.path.join(self.folder, name))
+        self.proc = await asyncio.create_subprocess_exec(
+            'Rscript', WORKER_SCRIPT, *self.packages,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+
+    async def _read_status(self):
+        while True:
+            try:
+                line = await self.proc.stdout.readline()
+            except ValueError:
+                # a long line, which cannot be a status
+                continue
+            if not line:
+                await self.close()
+                raise WorkerLost('The R worker exited')
+            # skip what the universe writes to the file descriptor itself
+            if line.startswith(_STATUS):
+                return line[len(_STATUS):].decode('utf-8').split()
+
+    async def spawn(self, script, cwd):
+        """
+        Start a universe.
+        :return: (the RChild, a StreamReader of its output, a StreamReader of
+            its messages)
+        """
+        if self.proc is None:
+            await self.start()
+
+        loop = asyncio.get_running_loop()
+        readers = []
+        keep = []
+        try:
+            for name in ('out', 'err'):
+                fn = os.path.join(self.folder, name)
+                # the read end opens right away, and our own write end keeps it
+                # from seeing the end of file before R opens the pipe
+                r = os.open(fn, os.O_RDONLY | os.O_NONBLOCK)
+                keep.append(os.open(fn, os.O_WRONLY | os.O_NONBLOCK))
+                reader = asyncio.StreamReader()
+                await loop.connect_read_pipe(
+                    lambda reader=reader: asyncio.StreamReaderProtocol(reader),
+                    os.fdopen(r, 'rb', 0))
+                readers.append(reader)
+
+            req = '\t'.join([os.path.abspath(os.path.join(cwd, script)), cwd,
+                             os.path.join(self.folder, 'out'),
+                             os.path.join(self.folder, 'err')])
+            self.proc.stdin.write(req.encode('utf-8') + b'\n')
+            await self.proc.stdin.drain()
+            await self._read_status()
+        finally:
+            for w in keep:
+                os.close(w)
+
+        return RChild(self), readers[0], readers[1]
+
+    async def wait(self, child):
+        """ Wait for a universe to finish, and return its exit code """
+        try:
+            status = await self._read_status()
+        except WorkerLost:
+            if child.returncode is None:
+                raise
+            return child.returncode
+
+        child.returncode = int(status[1])
+        if 'dirty' in status:
+            await self.close()
+        return child.returncode
+
+    async def close(self):
+        if self.proc is not None:
+            if self.proc.returncode is None:
+                self.proc.stdin.close()
+            await self.proc.wait()
+            self.proc = None
+        if self.folder is not None:
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self.folder = None
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Check the syntax of universe scripts with the tree-sitter grammars that the
+AST diff already builds, so that a universe that cannot even be parsed is
+reported before any universe runs.
+"""
+
+import os.path as osp
+from tree_sitter import Language, Parser
+
+# the parsers, loaded once per process
+_parsers = {}
+
+
+def get_grammar(lang):
+    """ The name of the tree-sitter grammar of a Lang, or None if there is none """
+    if lang.is_python():
+        return 'python'
+    if lang.is_r():
+        return 'r'
+    return None
+
+
+def _get_parser(grammar):
+    if grammar not in _parsers:
+        if grammar == 'python':
+            from src.gumtree.main.gen.python_tree_generator import BUILD_DIR, \
+                TREE_SITTER_DIR
+            Language.build_library(BUILD_DIR, [
+                osp.join(TREE_SITTER_DIR, 'tree-sitter-python')])
+        else:
+            from src.gumtree.main.gen.r_tree_generator import BUILD_DIR
+        parser = Parser()
+        parser.set_language(Language(BUILD_DIR, grammar))
+        _parsers[grammar] = parser
+    return _parsers[grammar]
+
+
+def find_error(node):
+    """
+    Find the first syntax error in a tree-sitter tree.
+    :return: an error message, or None if the tree has no error
+    """
+    if not node.has_error:
+        return None
+    if node.type == 'ERROR' or node.is_missing:
+        row, col = node.start_point
+        what = 'missing "{}"'.format(node.type) if node.is_missing else \
+            'syntax error'
+        return 'Line {}, column {}: {}'.format(row + 1, col + 1, what)
+    for child in node.children:
+        err = find_error(child)
+        if err:
+            return err
+
+    # the error is in the node itself
+    row, col = node.start_point
+    return 'Line {}, column {}: syntax error'.format(row + 1, col + 1)
+
+
+def check_code(grammar, batch):
+    """
+    Parse a batch of scripts.
+    :param grammar: the name of the grammar.
+    :param batch: an iterable of (universe id, code).
+    :return: a list of (universe id, error message) of the scripts that fail.
+    """
+    parser = _get_parser(grammar)
+    res = []
+    for uid, code in batch:
+        err = find_error(parser.parse(bytes(code, 'utf8')).root_node)
+        if err:
+            res.append((uid, err))
+    return res
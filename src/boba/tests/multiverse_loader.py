@@ -0,0 +1,31 @@
+import os
+
+import pandas as pd
+
+from src.boba.parser import Parser
+
+
+def compile_template(tmp_path, name, template):
+    """ Compile a template into tmp_path, and return the multiverse folder """
+    fn = tmp_path / name
+    fn.write_text(template)
+    Parser(str(fn), str(tmp_path)).main(verbose=False)
+    return str(tmp_path / 'multiverse')
+
+
+def read_results(folder):
+    """ The exit code, output and errors of each universe that ran """
+    logs = os.path.join(folder, 'boba_logs')
+    df = pd.read_csv(os.path.join(logs, 'logs.csv'))
+    res = {}
+    for uid, code in zip(df['uid'], df['exit_code']):
+        text = []
+        for name in ('log_{}.txt', 'error_{}.txt'):
+            fn = os.path.join(logs, name.format(uid))
+            if os.path.exists(fn):
+                with open(fn) as f:
+                    text.append(f.read())
+            else:
+                text.append('')
+        res[uid] = (code, *text)
+    return res
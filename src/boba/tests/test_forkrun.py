@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+from src.boba.bobarun import BobaRun
+from src.boba.forkrun import available
+from src.boba.tests.multiverse_loader import compile_template, read_results
+
+TEMPLATE = """# --- (BOBA_CONFIG)
+{"decisions": [
+  {"var": "a", "options": [1, 2, 3, 4]},
+  {"var": "b", "options": [1, 2, 3, 4]},
+  {"var": "c", "options": [1, 2, 3, 4]}
+]}
+# --- (END)
+import os, sys
+data = list(range(100))
+print('loaded', len(data))
+
+# --- (A)
+data = [d for d in data if d % {{a}}]
+print('a', len(data))
+
+# --- (B)
+data = [d * {{b}} for d in data]
+print('b', sum(data), file=sys.stderr)
+if {{a}} == 4 and {{b}} == 4:
+    sys.exit(3)
+
+# --- (C)
+group = os.getpgrp()
+live = 0
+for pid in os.listdir('/proc'):
+    try:
+        with open('/proc/%s/stat' % pid) as f:
+            stat = f.read()
+    except (OSError, ValueError):
+        continue
+    if int(stat.rsplit(')', 1)[1].split()[2]) == group:
+        live += 1
+with open({{procs}}, 'a') as f:
+    f.write('%d\\n' % live)
+if {{c}} == 2:
+    raise ValueError('c is two')
+print('result', sum(data) * {{c}})
+"""
+
+# the number of universes, and the depth of their fork tree
+SIZE = 64
+DEPTH = 3
+
+
+@pytest.mark.skipif(not available() or not os.path.exists('/proc/self/stat'),
+                    reason='needs fork and /proc')
+def test_fork_run_matches_plain_run(tmp_path):
+    procs = tmp_path / 'procs.txt'
+    folder = compile_template(
+        tmp_path, 'template.py',
+        TEMPLATE.replace('{{procs}}', repr(str(procs))))
+
+    jobs = 2
+    results = []
+    for fork in (False, True):
+        if procs.exists():
+            procs.unlink()
+        BobaRun(folder, jobs=jobs, fork=fork).run_multiverse(
+            list(range(1, SIZE + 1)))
+        results.append(read_results(folder))
+
+    plain, forked = results
+    assert len(plain) == SIZE
+    assert plain == forked
+    codes = sorted(set(code for code, _, _ in plain.values()))
+    assert codes == [0, 1, 3]
+
+    # the executor and the branches waiting for their children stay alive,
+    # but no more than a few per job at a time
+    live = [int(n) for n in procs.read_text().split()]
+    assert len(live) == SIZE - 4
+    assert max(live) <= jobs * (DEPTH + 2)
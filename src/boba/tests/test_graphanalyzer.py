@@ -0,0 +1,23 @@
+from src.boba.graphanalyzer import GraphAnalyzer
+from src.boba.graphparser import GraphParser
+
+
+def analyzer(spec, decs):
+    gp = GraphParser(spec)
+    gp.parse()
+    return GraphAnalyzer(*gp.replace_graph(decs))
+
+
+def test_count_matches_paths():
+    # parallel options of block decisions, and a branch that skips them
+    ga = analyzer(['A->B->C->D', 'A->C', 'B->D', 'A->E'],
+                  {'B': ['B:b1', 'B:b2', 'B:b3'], 'C': ['C:c1', 'C:c2']})
+    paths = list(ga.iter_paths())
+    assert ga.count() == len(paths) == 12
+    assert len(set(tuple(p) for p in paths)) == len(paths)
+
+
+def test_count_empty_graph():
+    ga = GraphAnalyzer(set(), [])
+    assert ga.count() == 0
+    assert list(ga.iter_paths()) == []
@@ -0,0 +1,110 @@
+import csv
+import os
+
+import numpy as np
+import pytest
+
+from src.boba.decisionmatrix import RowIndex
+from src.boba.parser import Parser, load_parser
+
+TEMPLATE = """# --- (BOBA_CONFIG)
+{"graph": ["A->M->B", "A->B"],
+ "decisions": [
+   {"var": "a", "options": [1, 2, 3]},
+   {"var": "b", "options": ["x", "y", "z"]},
+   {"var": "c", "options": [0.1, 0.5]}
+ ],
+ "constraints": [
+   {"variable": "b", "option": "y", "condition": "a == 1"},
+   {"link": ["c", "M"]}
+ ]}
+# --- (END)
+# --- (A)
+a = {{a}}
+# --- (M) m1
+m = {{c}}
+# --- (M) m2
+m = 2 * {{c}}
+# --- (B)
+b = '{{b}}'
+"""
+
+# the constraints leave 7 of the 9 combinations of a and b, on each of the
+# three ways through the graph: m1 with c=0.1, m2 with c=0.5, or skipping M
+SIZE = 21
+
+
+@pytest.fixture(params=['dense', 'hashed'])
+def index_mode(request, monkeypatch):
+    """ Build every index as a dense table, or as a hash table """
+    if request.param == 'hashed':
+        monkeypatch.setattr(RowIndex, 'DENSE_FACTOR', 0)
+        monkeypatch.setattr(RowIndex, 'DENSE_MIN', 0)
+    return request.param
+
+
+@pytest.fixture
+def compiled(tmp_path):
+    fn = tmp_path / 'template.py'
+    fn.write_text(TEMPLATE)
+    ps = Parser(str(fn), str(tmp_path))
+    ps.main(verbose=False)
+
+    with open(os.path.join(ps.out, 'summary.csv'), newline='') as f:
+        rows = list(csv.reader(f))
+    return ps, rows[0][1:], [r[1:] for r in rows[1:]]
+
+
+def test_count_matches_summary(compiled):
+    ps, _, rows = compiled
+    assert ps.count() == len(rows) == SIZE
+
+
+def test_index_modes(index_mode, compiled, tmp_path):
+    ps, _, _ = compiled
+    matrix = ps._get_rows()
+    idx = RowIndex.build(matrix, ps._get_radices())
+    assert (idx.table is not None) == (index_mode == 'dense')
+    assert (idx.slots is not None) == (index_mode == 'hashed')
+
+    fn = str(tmp_path / 'index.npz')
+    idx.save(fn)
+    for index in (idx, RowIndex.load(fn)):
+        for uid, row in enumerate(matrix, 1):
+            assert index.find(row) == uid
+        # a path that no universe takes
+        assert index.find([len(ps.paths) - 1] + [-1] * (matrix.shape[1] - 1)) \
+            is None
+
+
+@pytest.mark.parametrize('saved', [False, True])
+def test_lookup(index_mode, compiled, saved):
+    ps, names, rows = compiled
+    if saved:
+        ps = load_parser(ps.out)
+    assert (ps._get_index().slots is not None) == (index_mode == 'hashed')
+    for uid, row in enumerate(rows, 1):
+        decisions = {n: v for n, v in zip(names, row) if v != ''}
+        assert ps.lookup(decisions) == uid
+
+        # the linked decision c already tells the code path and the block
+        del decisions['Code Path']
+        decisions.pop('M', None)
+        assert ps.lookup(decisions) == uid
+
+    assert ps.lookup({'a': 4}) is None
+    assert ps.lookup({'a': 2, 'b': 'y'}) is None
+
+
+def test_neighbors(index_mode, compiled):
+    ps, names, rows = compiled
+    assert (ps._get_index().slots is not None) == (index_mode == 'hashed')
+    table = np.array(rows, dtype=object)
+    for uid, row in enumerate(rows, 1):
+        for j, name in enumerate(names[1:], 1):
+            # the universes that differ from this one only in the decision
+            others = np.delete(table, j, axis=1)
+            same = (others == np.delete(table[uid - 1], j)).all(axis=1)
+            expected = {rows[i][j]: i + 1 for i in np.flatnonzero(same)
+                        if rows[i][j] not in ('', row[j])}
+            assert ps.neighbors(uid, name) == expected
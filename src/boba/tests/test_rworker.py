@@ -0,0 +1,44 @@
+import pytest
+
+from src.boba.bobarun import BobaRun
+from src.boba.rworker import available
+from src.boba.tests.multiverse_loader import compile_template, read_results
+
+TEMPLATE = """# --- (BOBA_CONFIG)
+{"decisions": [
+  {"var": "a", "options": [1, 2, 3, 4]}
+]}
+# --- (END)
+library(tools)
+x <- {{a}}
+x * 2
+cat('value', x, file_ext('data.csv'), '\\n')
+message('a message')
+dir.create('sub', showWarnings = FALSE)
+setwd('sub')
+writeLines(as.character(x), 'out.txt')
+cat(basename(getwd()), '\\n')
+if (x == 2) warning('x is two')
+if (x == 3) stop('x is three')
+f <- function() warning('inside f')
+if (x == 4) f()
+print(readLines('out.txt'))
+"""
+
+SIZE = 4
+
+
+@pytest.mark.skipif(not available(), reason='needs Rscript')
+def test_worker_run_matches_plain_run(tmp_path):
+    folder = compile_template(tmp_path, 'template.R', TEMPLATE)
+
+    results = []
+    for preload in (None, ['stats']):
+        BobaRun(folder, preload=preload).run_multiverse(
+            list(range(1, SIZE + 1)))
+        results.append(read_results(folder))
+
+    plain, worker = results
+    assert len(plain) == SIZE
+    assert plain == worker
+    assert sorted(code for code, _, _ in plain.values()) == [0, 0, 0, 1]
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Regex tokenizers for the template syntax. Each one reads a line in a single
+pass and gives the same result as the scanner it replaces in
+blocksyntaxparser, decisionparser and conditionparser. Those scanners are
+kept as the reference: when a line does not match, we hand it to them so
+that they report the error exactly as before.
+"""
+
+import re
+
+from .blocksyntaxparser import BlockSyntaxParser
+from .conditionparser import ConditionParser, ParsedToken, TokenType
+
+_ID = r'[a-zA-Z][_a-zA-Z0-9]*'
+_WS = r'[ \t\n]*'
+
+# {{var}} or {{var=default}}. A run of braces opens the placeholder at its
+# last two braces, and a name that does not start with a letter, such as
+# {{_n}}, is a placeholder but not a decision.
+PLACEHOLDER = re.compile(
+    r'(\{\{+)(?:(?P<var>' + _ID + r')|(?P<other>(?![a-zA-Z])[_a-zA-Z0-9]*))'
+    + _WS + r'(?:=(?P<default>[^}]*)' + _WS + r')?\}\}')
+
+# # --- (ID) option @if condition
+BLOCK = re.compile(
+    _WS + r'# ---' + _WS + r'\(' + _WS + r'(?P<id>' + _ID + r')' + _WS + r'\)'
+    + _WS + r'(?:(?P<option>' + _ID + r')' + _WS + r')?'
+    + r'(?:@if(?![_a-zA-Z0-9])(?P<condition>.*))?', re.S)
+
+CONDITION = re.compile(
+    r'(?P<ws>[ \t\n]+)'
+    r'|(?P<id>' + _ID + r')(?P<attr>\.[_a-zA-Z0-9]*)?'
+    r'|(?P<number>[0-9]+(?:\.[0-9]*)?)'
+    r'|(?P<op>[=()!><]+)')
+
+
+def is_block(line):
+    """ Whether the line declares a block """
+    return BlockSyntaxParser.can_parse(line)
+
+
+def parse_block(line):
+    """
+    Parse a block declaration.
+    :return: (id, parameter, option, condition), as BlockSyntaxParser.parse
+    """
+    m = BLOCK.fullmatch(line)
+    if not m:
+        return BlockSyntaxParser(line).parse()
+
+    bid = m.group('id')
+    par, opt, cond = '', '', ''
+    if m.group('option'):
+        par, opt = bid, m.group('option')
+        bid += ':' + opt
+    if m.group('condition') is not None:
+        cond = {'block': par if opt else bid,
+                'condition': m.group('condition').strip()}
+        if opt:
+            cond['option'] = opt
+    return bid, par, opt, cond
+
+
+def find_placeholders(line):
+    """
+    Find the placeholders in a line of code.
+    :return: a generator of (start, end, name, is_decision, default), where
+        start and end delimit the placeholder, and default is the text after
+        "=", or None
+    """
+    if '{{' not in line:
+        return
+    for m in PLACEHOLDER.finditer(line):
+        start = m.end(1) - 2
+        if m.group('var') is not None:
+            yield start, m.end(), m.group('var'), True, m.group('default')
+        else:
+            yield start, m.end(), m.group('other'), False, m.group('default')
+
+
+def parse_condition(cond):
+    """
+    Parse a condition string.
+    :return: (code, decisions), as ConditionParser.parse
+    """
+    code = []
+    decs = []
+    i = 0
+    while i < len(cond):
+        m = CONDITION.match(cond, i)
+        if not m:
+            return ConditionParser(cond).parse()
+        i = m.end()
+
+        if m.group('id') is not None:
+            w, attr = m.group('id'), m.group('attr')
+            if ConditionParser._is_keyword(w):
+                if attr is not None:
+                    return ConditionParser(cond).parse()
+                code.append(w)
+                continue
+
+            # only the left hand side of == may have .index
+            tk = ParsedToken(w, TokenType.var)
+            if attr is not None:
+                if attr != '.index' or len(decs) % 2 == 1:
+                    return ConditionParser(cond).parse()
+                tk.type = TokenType.index_var
+            decs.append(tk)
+            code.append('{}')
+        elif m.group('number') is not None:
+            decs.append(ParsedToken(m.group('number'), TokenType.number))
+            code.append('{}')
+        else:
+            code.append(m.group(0))
+
+    return ''.join(code), decs
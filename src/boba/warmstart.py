@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Run Python universes in a pre-warmed interpreter. A worker is a long-lived
+process that imports a list of modules once, then forks a fresh child for
+each universe and runs the script in it with runpy, so that the universes
+share the cost of the imports. The child writes to the pipes of the
+supervisor and exits with the same code as "python universe_N.py" would.
+
+This file also runs as the worker itself, and so only depends on the
+standard library.
+"""
+
+import array
+import asyncio
+import atexit
+import importlib
+import json
+import os
+import runpy
+import shutil
+import signal
+import socket
+import sys
+import threading
+import traceback
+
+# the size of a file descriptor in a control message
+_FD_SIZE = array.array('i').itemsize
+
+
+class WorkerLost(ConnectionError):
+    """ A worker exited while it was running a universe """
+    pass
+
+
+def available():
+    """ Whether the platform can fork and pass file descriptors """
+    return hasattr(os, 'fork') and hasattr(socket, 'AF_UNIX') and \
+        hasattr(socket.socket, 'sendmsg')
+
+
+def python():
+    """
+    The interpreter that a plain run starts for "python", so that a universe
+    sees the same interpreter and packages in a worker
+    """
+    return shutil.which('python')
+
+
+def wait_code(status):
+    """ The exit code of a wait status, negative for a signal as in Popen """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def exit_code(e):
+    """ The exit code of a SystemExit, as the interpreter would report it """
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+def print_error(e, filenames):
+    """
+    Print an uncaught exception as the interpreter would, leaving out the
+    frames that come before those in one of the given files.
+    """
+    tb = e.__traceback__
+    while tb is not None and tb.tb_frame.f_code.co_filename not in filenames:
+        tb = tb.tb_next
+    traceback.print_exception(type(e), e, tb)
+
+
+def _recv_request(sock):
+    """ Receive a request and its file descriptors, or None at the end """
+    fds = []
+    data = b''
+    while not data.endswith(b'\n'):
+        msg, anc, _, _ = sock.recvmsg(4096, socket.CMSG_SPACE(2 * _FD_SIZE))
+        if not msg:
+            return None, []
+        data += msg
+        for level, kind, payload in anc:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds += array.array('i', payload[:len(payload) -
+                                                len(payload) % _FD_SIZE])
+    return json.loads(data.decode('utf-8')), fds
+
+
+def _run_script(script, cwd):
+    """ Run a script as __main__, and return its exit code """
+    os.chdir(cwd)
+    path = os.path.abspath(script)
+    sys.argv = [script]
+    sys.path.insert(0, os.path.dirname(path))
+    code = 0
+    try:
+        runpy.run_path(path, run_name='__main__')
+    except SystemExit as e:
+        code = exit_code(e)
+    except BaseException as e:
+        # leave out the frames of runpy, as the interpreter would
+        print_error(e, {path})
+        code = 1
+
+    # shut down as the interpreter would
+    if hasattr(threading, '_shutdown'):
+        threading._shutdown()
+    atexit._run_exitfuncs()
+    return code
+
+
+def serve(fd, modules):
+    """ The main loop of a worker """
+    for m in modules:
+        try:
+            importlib.import_module(m)
+        except Exception as e:
+            print('Cannot preload module "{}": {}'.format(m, e),
+                  file=sys.stderr)
+
+    sock = socket.socket(fileno=fd)
+    while True:
+        req, fds = _recv_request(sock)
+        if req is None:
+            break
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                sock.close()
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                os.dup2(fds[0], 1)
+                os.dup2(fds[1], 2)
+                for f in fds:
+                    os.close(f)
+                code = _run_script(req['script'], req['cwd'])
+            finally:
+                try:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                finally:
+                    os._exit(code)
+
+        for f in fds:
+            os.close(f)
+        sock.sendall('pid {}\n'.format(pid).encode('utf-8'))
+        _, status = os.waitpid(pid, 0)
+        sock.sendall('exit {}\n'.format(wait_code(status)).encode('utf-8'))
+
+
+class WarmChild:
+    """ A universe running in a child of a worker """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def terminate(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+class WarmWorker:
+    """
+    The supervisor side of a worker, to use from an event loop. The worker
+    starts with the first universe, and again after it is lost.
+    """
+
+    def __init__(self, modules):
+        self.modules = list(modules)
+        self.proc = None
+        self.sock = None
+        self._buffer = b''
+
+    @staticmethod
+    def can_run(cmds, script, cwd):
+        """ Whether the commands of a universe only run it with python """
+        return cmds == [['python', script]] and python() is not None
+
+    async def start(self):
+        ours, theirs = socket.socketpair()
+        self.proc = await asyncio.create_subprocess_exec(
+            python(), os.path.abspath(__file__), str(theirs.fileno()),
+            *self.modules, pass_fds=(theirs.fileno(),),
+            stdout=asyncio.subprocess.DEVNULL)
+        theirs.close()
+        ours.setblocking(False)
+        self.sock = ours
+        self._buffer = b''
+
+    async def _read_line(self):
+        loop = asyncio.get_running_loop()
+        while b'\n' not in self._buffer:
+            data = await loop.sock_recv(self.sock, 4096)
+            if not data:
+                await self.close()
+                raise WorkerLost('The warm worker exited')
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line.decode('utf-8').split(' ')
+
+    async def spawn(self, script, cwd):
+        """
+        Start a universe.
+        :return: (the WarmChild, a StreamReader of its standard output, a
+            StreamReader of its standard error)
+        """
+        if self.sock is None:
+            await self.start()
+
+        loop = asyncio.get_running_loop()
+        readers = []
+        fds = array.array('i')
+        try:
+            for _ in range(2):
+                r, w = os.pipe()
+                fds.append(w)
+                reader = asyncio.StreamReader()
+                await loop.connect_read_pipe(
+                    lambda reader=reader: asyncio.StreamReaderProtocol(reader),
+                    os.fdopen(r, 'rb', 0))
+                readers.append(reader)
+
+            req = json.dumps({'script': script, 'cwd': cwd}) + '\n'
+            self.sock.sendmsg([req.encode('utf-8')],
+                              [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+        finally:
+            # the child holds the only write ends, so we see it exit
+            for w in fds:
+                os.close(w)
+
+        _, pid = await self._read_line()
+        return WarmChild(int(pid)), readers[0], readers[1]
+
+    async def wait(self, child):
+        """ Wait for a universe to finish, and return its exit code """
+        _, code = await self._read_line()
+        child.returncode = int(code)
+        return child.returncode
+
+    async def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.proc is not None:
+            await self.proc.wait()
+            self.proc = None
+
+
+if __name__ == '__main__':
+    # do not let the folder of this file shadow the modules to preload
+    sys.path.pop(0)
+    serve(int(sys.argv[1]), sys.argv[2:])
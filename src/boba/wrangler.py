@@ -2,11 +2,18 @@
 
 import os
 import shutil
+import subprocess
+import sys
+import uuid
 import csv
 import json
+import hashlib
 from typing import Union
 from dataclasses import dataclass
 from .baseparser import ParseError
+from .decisionmatrix import DecisionMatrix
+import numpy as np
+import pandas as pd
 from tqdm import tqdm
 
 
@@ -18,6 +25,18 @@ class Output:
 
 DIR_SCRIPT = 'code/'
 DIR_LOG = 'boba_logs/'
+DIR_PARSER = '.boba_parser/'
+FILE_MATRIX = 'universes.npy'
+FILE_INDEX = 'index.npz'
+FILE_MANIFEST = 'manifest.json'
+FILE_ALIASES = 'aliases.json'
+FILE_PACK = 'universes.pack'
+FILE_PACK_INDEX = 'universes.index.npy'
+FILE_SUMMARY = 'summary.csv'
+FILE_SUMMARY_COLUMNS = 'summary.npz'
+FILE_PROFILE = 'profile.json'
+FILE_RUNTIMES = 'runtimes.npy'
+FILE_FORK = 'fork.json'
 LOG_EXT = '.txt'
 
 def get_universe_name(universe_id):
@@ -35,6 +54,201 @@ def get_universe_id_from_script(universe_script):
     return int(universe_script.split('.')[0].split('_')[1])
 
 
+def can_render(folder):
+    """ Whether the universes in the folder can be rendered on demand """
+    return os.path.exists(os.path.join(folder, DIR_SCRIPT, DIR_PARSER,
+                                       FILE_MATRIX))
+
+
+def read_packed_universe(folder, universe_id):
+    """ Read a universe script from the pack, or None if it is not packed """
+    fn = os.path.join(folder, DIR_SCRIPT, FILE_PACK)
+    if not os.path.exists(fn):
+        return None
+
+    offsets = np.load(os.path.join(folder, DIR_SCRIPT, FILE_PACK_INDEX),
+                      mmap_mode='r')
+    if not 0 < universe_id < len(offsets):
+        return None
+    start = int(offsets[universe_id - 1])
+    with open(fn, 'rb') as f:
+        f.seek(start)
+        return f.read(int(offsets[universe_id]) - start).decode('utf-8')
+
+
+def peek_summary(folder):
+    """ Get the number of universes and the file name of the first one """
+    fn = os.path.join(folder, FILE_SUMMARY_COLUMNS)
+    if os.path.exists(fn):
+        with np.load(fn) as data:
+            return data['codes'].shape[0], \
+                get_universe_script(1, str(data['ext']))
+
+    df = pd.read_csv(os.path.join(folder, FILE_SUMMARY), usecols=['Filename'])
+    return df.shape[0], df['Filename'].iloc[0]
+
+
+def _load_decision_matrix(folder):
+    """
+    Load the decision matrix of the summary. R universes record their outputs
+    in the CSV file as they run, so if it changed after the compile, the
+    output columns come from the CSV file instead.
+    """
+    fn = os.path.join(folder, FILE_SUMMARY_COLUMNS)
+    matrix = DecisionMatrix.load(fn)
+    with np.load(fn) as data:
+        outputs = [str(n) for n in data['outputs']] \
+            if 'outputs' in data else []
+
+    fn_csv = os.path.join(folder, FILE_SUMMARY)
+    if len(outputs) == 0 or not os.path.exists(fn_csv) or \
+            os.stat(fn_csv).st_mtime_ns <= os.stat(fn).st_mtime_ns:
+        return matrix
+
+    with open(fn_csv, newline='') as f:
+        rows = csv.reader(f)
+        header = next(rows)
+        cols = [header.index(n) for n in outputs]
+        # R writes the outputs of universes that have not run as NA
+        values = [[r[j] if j < len(r) and r[j] != 'NA' else '' for j in cols]
+                  for r in rows]
+    return matrix.replace_columns(outputs, values)
+
+
+def read_decision_matrix(folder):
+    """
+    Read the decision matrix of the summary: the code path, every decision and
+    every output, per universe. Fall back to encoding the CSV file.
+    """
+    fn = os.path.join(folder, FILE_SUMMARY_COLUMNS)
+    if os.path.exists(fn):
+        return _load_decision_matrix(folder)
+
+    with open(os.path.join(folder, FILE_SUMMARY), newline='') as f:
+        rows = list(csv.reader(f))
+    return DecisionMatrix.from_rows(rows[0][1:], [r[1:] for r in rows[1:]])
+
+
+def read_summary(folder, na_value=None):
+    """
+    Read the summary as a data frame. Prefer the decision matrix, where every
+    column except the file name is categorical; otherwise read the CSV file.
+    Missing values are NaN, or na_value if it is given.
+    """
+    fn = os.path.join(folder, FILE_SUMMARY_COLUMNS)
+    if not os.path.exists(fn):
+        df = pd.read_csv(os.path.join(folder, FILE_SUMMARY))
+        return df if na_value is None else df.fillna(na_value)
+
+    with np.load(fn) as data:
+        ext = str(data['ext'])
+    df = _load_decision_matrix(folder).to_frame(na_value)
+    df.insert(0, 'Filename', [get_universe_script(i + 1, ext)
+                              for i in range(len(df))])
+    return df
+
+
+def _sibling(folder, tag):
+    """ A hidden, unused path next to a folder, such as .multiverse.old-1a2b """
+    parent, base = os.path.split(os.path.normpath(folder))
+    return os.path.join(parent, '.{}.{}-{}'.format(base, tag,
+                                                    uuid.uuid4().hex[:8]))
+
+
+def remove_in_background(folder):
+    """
+    Delete a folder in a detached process, which outlives the command that
+    starts it. If it is interrupted, boba gc removes what is left.
+    """
+    subprocess.Popen([sys.executable, '-c',
+                      'import shutil, sys; shutil.rmtree(sys.argv[1], True)',
+                      folder], stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+
+
+def rotate_dir(folder, new=None):
+    """
+    Move a folder out of the way with an atomic rename, and delete it in the
+    background. Unlike deleting it in place, this is instant, and a crash
+    never leaves a half-deleted folder behind.
+
+    Putting a new folder in its place takes a second rename, so a crash in
+    between leaves no folder at all. The new folder is first renamed to a
+    .ready sibling, which recover_dir then moves into place.
+
+    :param folder: the folder to replace.
+    :param new: a folder to rename to its place, or None to leave it empty.
+    """
+    if new is not None:
+        ready = _sibling(folder, 'ready')
+        os.rename(new, ready)
+        new = ready
+
+    old = None
+    if os.path.exists(folder):
+        old = _sibling(folder, 'old')
+        os.rename(folder, old)
+    if new is not None:
+        os.rename(new, folder)
+    if old is not None:
+        remove_in_background(old)
+
+
+def recover_dir(folder):
+    """
+    Finish a rotate_dir that was interrupted between its two renames, by
+    moving the newest .ready sibling of a missing folder into its place.
+
+    :return: whether the folder was recovered.
+    """
+    if os.path.exists(folder):
+        return False
+    parent, base = os.path.split(os.path.normpath(folder))
+    prefix = '.{}.ready-'.format(base)
+    ready = [d for d in find_stale_dirs(folder)
+             if os.path.basename(d).startswith(prefix)]
+    if len(ready) == 0:
+        return False
+
+    os.rename(max(ready, key=os.path.getmtime), folder)
+    print('Recovered {} from an interrupted compile.'.format(folder))
+    return True
+
+
+def find_stale_dirs(folder):
+    """
+    Find the folders that rotate_dir moved out of the way, and the unfinished
+    builds of compiles that crashed, next to a folder.
+    """
+    parent, base = os.path.split(os.path.normpath(folder))
+    prefixes = tuple('.{}.{}-'.format(base, tag)
+                     for tag in ('old', 'new', 'ready'))
+    if not os.path.isdir(parent or '.'):
+        return []
+    return sorted(os.path.join(parent, fn) for fn in os.listdir(parent or '.')
+                  if fn.startswith(prefixes))
+
+
+def read_runtimes(folder, n):
+    """
+    Read how long each universe took when it last ran.
+    :return: an array of n seconds, NaN for universes that have not run.
+    """
+    res = np.full(n, np.nan)
+    try:
+        prev = np.load(os.path.join(folder, FILE_RUNTIMES))
+        res[:min(n, len(prev))] = prev[:n]
+    except (IOError, ValueError):
+        pass
+    return res
+
+
+def write_runtimes(folder, runtimes):
+    """ Write how long each universe took """
+    np.save(os.path.join(folder, FILE_RUNTIMES), runtimes)
+
+
 def get_universe_log(universe_id):
     """ Get the file name of a universe log """
     return 'log_' + str(universe_id) + LOG_EXT
@@ -51,7 +265,10 @@ class Wrangler:
         self.spec = spec
         self.lang = lang
         self.out = out
-        self.fn = os.path.abspath(os.path.join(out, 'summary.csv'))
+        self.fn = os.path.abspath(os.path.join(out, FILE_SUMMARY))
+
+        # a new multiverse is built in a sibling folder, then swapped in
+        self.dest = out
 
         self.outputs = {}
         self.col = 0  # output column number, will be set by parser
@@ -61,7 +278,30 @@ class Wrangler:
         self.post_exe = ''
 
         self._read_spec()
-        self.pbar = Union[None, tqdm]
+        self.pbar: Union[None, tqdm] = None
+
+        # in an incremental compile, the manifest of the previous compile
+        self.manifest = None
+        self.hashes = {}
+
+        # in a packed compile, the open pack and the offset of each universe
+        self.pack = None
+        self.offsets = []
+
+        # the summary CSV file, while the universes are generated, and in an
+        # incremental compile, the previous one and its output columns
+        self.summary = None
+        self.summary_writer = None
+        self.prev_summary = None
+        self.prev_rows = None
+        self.prev_cols = []
+
+    def __getstate__(self):
+        # the open files belong to the process that writes them
+        state = self.__dict__.copy()
+        state['pack'] = state['summary'] = state['summary_writer'] = None
+        state['prev_summary'] = state['prev_rows'] = None
+        return state
 
     @staticmethod
     def _read_json_safe(obj, field):
@@ -85,7 +325,7 @@ class Wrangler:
         self.pre_exe = self._read_optional(self.spec, 'before_execute', '')
         self.post_exe = self._read_optional(self.spec, 'after_execute', '')
 
-    def _codegen_r(self):
+    def _codegen_r(self, universe_id):
         """Generate output code for R scripts."""
         if len(self.outputs) == 0:
             return ''
@@ -99,7 +339,7 @@ class Wrangler:
         # record outputs
         ns = self.get_outputs()
         col = self.col + 1
-        row = self.counter
+        row = universe_id
         for n in ns:
             code += '\ndf[{}, {}] = {}'.format(row, col, self.outputs[n].value)
             col += 1
@@ -110,18 +350,18 @@ class Wrangler:
 
         return code
 
-    def _codegen_python(self):
+    def _codegen_python(self, universe_id):
         if len(self.outputs) == 0:
             return ''
 
         # TODO
 
-    def _gen_code(self):
+    def _gen_code(self, universe_id):
         """Generate output code to be appended to the end of the script."""
         if self.lang.is_r():
-            return self._codegen_r()
+            return self._codegen_r(universe_id)
         if self.lang.is_python():
-            return self._codegen_python()      
+            return self._codegen_python(universe_id) or ''
         return ''
 
     def write_pre_exe(self):
@@ -140,35 +380,199 @@ class Wrangler:
             json.dump(self.lang.supported_langs, f)
 
 
-    def write_universe(self, code, cur_block_code):
-        """Write the generated code to a universe file."""
+    def render_universe(self, universe_id, code):
+        """Fill in the reserved keywords and append the output code."""
+        # replace the reserved keyword _n
+        code = code.replace('{{_n}}', str(universe_id))
+
+        # append output code
+        return code + self._gen_code(universe_id)
 
-        self.counter += 1
+    def write_universe(self, universe_id, code):
+        """Write the rendered code to a universe file."""
+        self.counter = universe_id
         if self.pbar is not None:
             self.pbar.update(1)
-        fn = get_universe_script(self.counter, self.lang.get_ext())
-
-        # replace the reserved keyword _n
-        code = code.replace('{{_n}}', str(self.counter))
-        cur_block_code = cur_block_code.replace('{{_n}}', str(self.counter))
-        
-        # append output code
-        code += self._gen_code()
-        cur_block_code += self._gen_code()
+        fn = get_universe_script(universe_id, self.lang.get_ext())
+        path = os.path.join(self.out, DIR_SCRIPT, fn)
+
+        data = code.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        self.hashes[universe_id] = digest
+
+        # in a packed compile, append to the pack
+        if self.pack is not None:
+            self.pack.write(data)
+            self.offsets.append(self.offsets[-1] + len(data))
+            return fn
+
+        # in an incremental compile, skip the file if it has not changed
+        if self.manifest is not None:
+            prev = self.manifest['hashes']
+            if universe_id <= len(prev) and prev[universe_id - 1] == digest \
+                    and os.path.exists(path):
+                return fn
 
         # write file
-        with open(os.path.join(self.out, DIR_SCRIPT, fn), 'w') as f:
+        with open(path, 'w') as f:
             f.write(code)
-            f.flush()
 
-        return fn, code, cur_block_code
-
-    def write_summary(self, rows):
-        """Write the summary CSV file"""
-        with open(self.fn, 'w', newline='') as f:
-            wrt = csv.writer(f)
-            for row in rows:
-                wrt.writerow(row)
+        return fn
+
+    def open_pack(self):
+        """Start a pack, which holds all universe scripts in one file"""
+        fn = os.path.join(self.out, DIR_SCRIPT, FILE_PACK)
+        self.pack = open(fn, 'wb')
+        self.offsets = [0]
+
+    def close_pack(self):
+        """Finish the pack and write its index, the offset of each universe"""
+        self.pack.close()
+        self.pack = None
+        np.save(os.path.join(self.out, DIR_SCRIPT, FILE_PACK_INDEX),
+                np.array(self.offsets, dtype=np.int64))
+        self.offsets = []
+
+    def remove_pack(self):
+        """Remove the pack of a previous compile, if any"""
+        for fn in (FILE_PACK, FILE_PACK_INDEX):
+            path = os.path.join(self.out, DIR_SCRIPT, fn)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def read_manifest(self):
+        """Read the manifest of the previous compile, if any"""
+        fn = os.path.join(self.out, DIR_SCRIPT, DIR_PARSER, FILE_MANIFEST)
+        try:
+            with open(fn, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def is_kept(self, universe_id, code_hash, decisions):
+        """
+        Whether a universe made the same decisions and has the same code as in
+        the previous compile, so that its logs and results are still valid.
+
+        :param code_hash: the hash of its script, or None if there is none.
+        :param decisions: the digest of its decisions.
+        """
+        prev = self.manifest
+        i = universe_id - 1
+        return prev is not None and code_hash is not None \
+            and i < len(prev['hashes']) and i < len(prev['decisions']) \
+            and prev['hashes'][i] == code_hash \
+            and prev['decisions'][i] == decisions
+
+    def write_manifest(self, hashes, decisions):
+        """
+        Write the manifest, which records the hash of each universe script and
+        a digest of the decisions it made. Universes that are the same as in
+        the previous compile are listed as kept. A virtual compile has no
+        hashes to compare, so it keeps no universe.
+        """
+        kept = [i + 1 for i, (h, d) in enumerate(zip(hashes, decisions))
+                if self.is_kept(i + 1, h, d)]
+
+        folder = os.path.join(self.out, DIR_SCRIPT, DIR_PARSER)
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, FILE_MANIFEST), 'w') as f:
+            json.dump({'hashes': hashes, 'decisions': decisions,
+                       'kept': kept}, f)
+        return kept
+
+    def write_aliases(self, aliases):
+        """
+        Write the aliases, which map a universe to an earlier universe with
+        byte-identical code.
+        """
+        with open(os.path.join(self.out, FILE_ALIASES), 'w') as f:
+            json.dump({str(k): v for k, v in aliases.items()}, f)
+
+    def remove_stale_universes(self, n):
+        """Remove the universe scripts of a previous compile beyond the first n"""
+        folder = os.path.join(self.out, DIR_SCRIPT)
+        ext = self.lang.get_ext()
+        for fn in os.listdir(folder):
+            if fn.startswith(get_universe_name('')) and fn.endswith(ext) \
+                    and get_universe_id_from_script(fn) > n:
+                os.remove(os.path.join(folder, fn))
+
+    def write_matrix(self, matrix):
+        """
+        Write the decision matrix, one row per universe, which holds the code
+        path and option indices that render the universe. The matrix of the
+        summary cannot stand in for it: a skipped block drops out of the code
+        path and its decision from the summary, so different universes can
+        share a summary row.
+        """
+        folder = os.path.join(self.out, DIR_SCRIPT, DIR_PARSER)
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, FILE_MATRIX), matrix)
+
+    def write_index(self, index):
+        """Write the index from the decisions to the universe id"""
+        index.save(os.path.join(self.out, DIR_SCRIPT, DIR_PARSER, FILE_INDEX))
+
+    def open_summary(self, header):
+        """
+        Start the summary CSV file, whose rows are written as they are made. In
+        an incremental compile, the previous file is moved aside and read
+        along, as R universes record their outputs in it.
+        """
+        fn = os.path.join(self.out, FILE_SUMMARY)
+        if self.manifest is not None and os.path.exists(fn):
+            prev = os.path.join(self.out, '.' + FILE_SUMMARY + '.old')
+            os.replace(fn, prev)
+            self.prev_summary = open(prev, newline='')
+            self.prev_rows = csv.reader(self.prev_summary)
+            prev_header = next(self.prev_rows, [])
+            self.prev_cols = [prev_header.index(n) if n in prev_header
+                              else None for n in self.get_outputs()]
+
+        self.summary = open(fn, 'w', newline='')
+        self.summary_writer = csv.writer(self.summary)
+        self.summary_writer.writerow(header)
+
+    def read_kept_outputs(self, universe_id, decisions):
+        """
+        The outputs a universe recorded in the previous summary, if it is kept,
+        or an empty list. It must be called for every universe, in order, after
+        its script is written.
+
+        :param decisions: the digest of its decisions.
+        """
+        if self.prev_rows is None:
+            return []
+        row = next(self.prev_rows, None)
+        if row is None or not self.is_kept(
+                universe_id, self.hashes.get(universe_id), decisions):
+            return []
+
+        # R writes the outputs of universes that have not run as NA
+        return [row[j] if j is not None and j < len(row) and row[j] != 'NA'
+                else '' for j in self.prev_cols]
+
+    def write_summary_row(self, row):
+        """Write the row of a universe to the summary CSV file"""
+        self.summary_writer.writerow(row)
+
+    def close_summary(self):
+        self.summary.close()
+        self.summary = self.summary_writer = None
+        if self.prev_summary is not None:
+            self.prev_summary.close()
+            os.remove(self.prev_summary.name)
+            self.prev_summary = self.prev_rows = None
+
+    def write_decision_matrix(self, matrix):
+        """
+        Write the decision matrix of the summary. The file names are left out,
+        as they follow from the universe id.
+        """
+        matrix.save(os.path.join(self.out, FILE_SUMMARY_COLUMNS),
+                    ext=np.array(self.lang.get_ext()),
+                    outputs=np.array(self.get_outputs(), dtype=str))
 
     def write_overview_json(self, res):
         """ Write the overview.json file"""
@@ -196,13 +600,30 @@ class Wrangler:
             obj = json.dumps(res, indent=2, sort_keys=True)
             f.write(obj)
 
-    def create_dir(self):
-        """Create output directories."""
-        if os.path.exists(self.out):
-            shutil.rmtree(self.out)
-        os.makedirs(self.out)
+    def create_dir(self, incremental=False):
+        """
+        Create output directories. In an incremental compile, keep the previous
+        outputs and read its manifest instead. Otherwise, the outputs go to a
+        new sibling folder until swap_dir replaces the previous outputs.
+        """
+        self.manifest = None
+        self.hashes = {}
+        self.out = self.dest
+        recover_dir(self.dest)
+        if incremental and os.path.exists(os.path.join(self.out, DIR_SCRIPT)):
+            self.manifest = self.read_manifest() or {'hashes': [],
+                                                     'decisions': []}
+            return
+
+        self.out = _sibling(self.dest, 'new')
         os.makedirs(os.path.join(self.out, DIR_SCRIPT))
 
+    def swap_dir(self):
+        """ Replace the previous outputs with the folder built by create_dir """
+        if self.out != self.dest:
+            rotate_dir(self.dest, self.out)
+            self.out = self.dest
+
     def get_outputs(self):
         """Get a sorted list of output names."""
         return sorted(list(self.outputs.keys()))
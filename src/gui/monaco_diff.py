@@ -1,5 +1,6 @@
 from typing import List
 from src.boba.parser import Parser
+from src.boba.wrangler import read_packed_universe
 
 import os.path as osp
 from src.gumtree.main.client.boba_template_diff import TemplateDiff
@@ -12,13 +13,36 @@ class TemplateDiffView:
     def __init__(self, ps: Parser, dst_file: str):
         universe_num = int(osp.basename(dst_file).split('.')[0].split('_')[-1])
         self.dst_file = dst_file
-        with open(dst_file, 'r') as f:
-            universe_code = f.read()
+        self.universe_num = universe_num
+        if osp.exists(dst_file):
+            with open(dst_file, 'r') as f:
+                universe_code = f.read()
+        else:
+            # the universe is read from the pack, or rendered on demand in a
+            # virtual multiverse
+            universe_code = read_packed_universe(
+                osp.dirname(osp.dirname(dst_file)), universe_num)
+            if universe_code is None:
+                universe_code = ps.get_universe(universe_num)[1]
         self.template_diff: TemplateDiff = TemplateDiff(ps, universe_code, universe_num)
         self.template_code_pos = self.template_diff.template_code_pos
         self.new_template_u_code_pos: CodePos = self.template_diff.new_template_u_code_pos
         self.new_template_i_code_pos: CodePos = self.template_diff.new_template_i_code_pos
         
+    def get_neighbors(self):
+        """
+        The universes that differ from this one in exactly one decision, as a
+        dict from decision to a dict from the other option to the universe.
+        """
+        ps = self.template_diff.boba_parser
+        res = {}
+        for dec in list(ps.dec_parser.discrete_decisions) + \
+                list(ps.code_parser.get_decisions()):
+            nbs = ps.neighbors(self.universe_num, dec)
+            if len(nbs):
+                res[dec] = nbs
+        return res
+
     def get_all_config(self):
         return ('config = {{ file: "{}", oldUniverse: {}, newUniverse: {}, '
                 'oldTemplate: {}, newTemplate: {}, '
@@ -44,8 +44,9 @@ def save_editor_and_compile():
         f.write(request.form.get('editor_text'))
     ret_text = 'Saved new template to ' + save_path
     
+    old = diff_view.template_diff.boba_parser
     ps = Parser(save_path, osp.dirname(save_path))
-    ps.main_wo_warning()
+    ps.main_wo_warning(virtual=old.virtual, incremental=True, pack=old.packed)
     ex = """Finished compiling muiltiverse. To execute the multiverse, run the following commands:
     boba run --all
     """.format(osp.join(osp.dirname(save_path), 'multiverse'))
@@ -64,6 +65,11 @@ def new_universe():
     diff_view: TemplateDiffView = app_diff.diff_view
     return diff_view.template_diff.dst_code
 
+@app_diff.route('/neighbors')
+def neighbors():
+    diff_view: TemplateDiffView = app_diff.diff_view
+    return jsonify(diff_view.get_neighbors())
+
 @app_diff.route('/old_template')
 def old_template():
     diff_view: TemplateDiffView = app_diff.diff_view
@@ -1,6 +1,6 @@
 import click
 import os.path as osp
-import pickle
+from src.boba.parser import load_parser
 from src.gui import app_diff, app_error_dashboard
 from src.gui.monaco_diff import TemplateDiffView
 from src.aggregate_error import DebugMultiverse
@@ -11,19 +11,20 @@ def diff_helper(universe_path):
     universe_path = osp.realpath(universe_path)
     print(universe_path)
     dir_code = osp.dirname(universe_path)
-    parser_pickle_path = osp.join(dir_code, '.boba_parser', 'parser.pickle')
-    if not osp.exists(parser_pickle_path):
+    ps = load_parser(osp.dirname(dir_code))
+    if ps is None:
         print('Cached boba parser does not exist. Could not run bdiff')
         return
-    with open(parser_pickle_path, 'rb') as f:
-        ps = pickle.load(f)
+    if not ps.virtual and not ps.packed and not osp.exists(universe_path):
+        print('Universe "{}" does not exist.'.format(universe_path))
+        return
     print('Calculating Diff ...')
     template_diff_view = TemplateDiffView(ps, universe_path)
     return template_diff_view
 
 
 @click.command()
-@click.argument('universe_path', type=click.Path(exists=True))
+@click.argument('universe_path', type=click.Path())
 @click.option('--port', default=8080, show_default=True,
               help='The port to bind the server to')
 @click.option('--host', default='0.0.0.0', show_default=True,
@@ -44,7 +44,7 @@ class TemplateDiff(LineDiff):
 		
 		self.boba_parser = ps
 		self.universe_num = universe_num
-		self.history: History = ps.history[universe_num - 1]
+		self.history: History = ps.get_universe(universe_num)[0]
 		intermediary_code = self.boba_parser.paths_code[self.history.path]
 		u_code = deepcopy(intermediary_code)
 		decision_dict = self.history.decision_dict
@@ -64,7 +64,7 @@ class TemplateDiff(LineDiff):
 		super().__init__(u_code, universe_code, configurations)
 		self.diff: Diff = self.get_diff()
 		blocks = get_universe_blocks_from_template_blocks(self.boba_parser.code_parser.blocks,
-														  self.boba_parser.blocks_code[self.universe_num - 1])
+														  self.history.blocks)
 		self.tc = get_tree_chunks_from_blocks(self.diff.src.root, 
 										 blocks,
 										 decision_dict)
@@ -75,7 +75,7 @@ class TemplateDiff(LineDiff):
 		self.old_u_t_diff = OffsetsFromBobaVar.init_from_tree_chunks(self.tc)
 		self.new_u_t_diff = OffsetsFromBobaVar.init_from_mapped_vars(self.dst_code, mapped_boba_vars)
 		
-		u_code_blocks: List[BlockCode] = clean_code_blocks(self.boba_parser.blocks_code[self.universe_num - 1])
+		u_code_blocks: List[BlockCode] = clean_code_blocks(self.history.blocks)
 		template_code_blocks: List[BlockCode] = clean_code_blocks(self.boba_parser.code_parser.all_blocks)
 		self.template_code = self.boba_parser.template_code
 		self.template_code_pos = CodePos(u_code,
@@ -231,7 +231,7 @@ class BobaLineDiff(LineDiff):
         
         self.boba_parser = ps
         self.universe_num = universe_num
-        self.history: History = ps.history[universe_num - 1]
+        self.history: History = ps.get_universe(universe_num)[0]
         template_code = self.boba_parser.paths_code[self.history.path]
         configurations = {
             "generator": self.DEFAULT_GENERATOR,
@@ -34,13 +34,14 @@ if __name__ == "__main__":
     save_file = osp.join(DATA_DIR, f'{dataset}_template_parser_obj_0718.pickle')
     ps = load_parser_example(dataset, ext, save_file)
     universe_num = 3
-    template_code = ps.paths_code[ps.history[universe_num - 1].path]
+    history = ps.get_universe(universe_num)[0]
+    template_code = ps.paths_code[history.path]
     universe_code = read_universe_file(universe_num, dataset, ext)
     configurations = {
         "formatter": "text",
         "generator": ("boba_python_template", "python"),
         "matcher": "boba",
-        "parser_history": ps.history[universe_num - 1],
+        "parser_history": history,
         "priority_queue": "python"
     }
     
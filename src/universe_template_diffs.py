@@ -20,7 +20,7 @@ def read_file_against_template(fpath, code_blocks):
 
 def get_diff(fpath: str, boba_parser: Parser):
     universe_num = int(osp.basename(fpath).split('.')[0].split('_')[-1])
-    code_blocks = boba_parser.blocks_code[universe_num-1]
+    code_blocks = boba_parser.get_universe(universe_num)[0].blocks
     orig_code_lines, changed_code_lines = read_file_against_template(fpath, code_blocks)
     
     def cumsum(code_blocks):